@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Check of the crash recovery paths of txfr_manifest.py using a stub transfer client. No Globus access needed.
+#   - A torn last record, as left by a crash during a write, is dropped and the job resumes.
+#   - A crash after a submit record but before the task record resubmits with the same submission_id,
+#     so no duplicate task is created.
+#
+import os
+import tempfile
+import txfr_manifest
+from txfr_manifest import open_manifest, submit_pending_chunks, refresh_chunk_status, manifest_summary, \
+    CHUNK_SUBMITTED, CHUNK_SUCCEEDED
+
+
+class StubTransferClient:
+    """Behaves like Globus for submission ids: resubmitting a submission_id returns the original task."""
+
+    def __init__(self):
+        self.num_submission_ids = 0
+        self.tasks_by_submission = {}
+        self.task_status = {}
+        self.fail_after_submit = False
+
+    def get_submission_id(self):
+        self.num_submission_ids += 1
+        return {"value": "submission-{}".format(self.num_submission_ids)}
+
+    def submit_transfer(self, data):
+        submission_id = data["submission_id"]
+        if submission_id not in self.tasks_by_submission:
+            self.tasks_by_submission[submission_id] = "task-{}".format(len(self.tasks_by_submission) + 1)
+        if self.fail_after_submit:
+            # Globus has the task but we crash before the task record is written
+            self.fail_after_submit = False
+            raise RuntimeError("Simulated crash after submit")
+        return {"task_id": self.tasks_by_submission[submission_id]}
+
+    def get_task(self, task_id):
+        return {"status": self.task_status.get(task_id, "ACTIVE")}
+
+
+def make_items(num_items):
+    return [{'source': "/src/file{}".format(i), 'dest': "/dst/file{}".format(i)} for i in range(num_items)]
+
+
+def check_torn_tail():
+    manifest_file = os.path.join(tempfile.mkdtemp(), "manifest.jsonl")
+    items = make_items(25)
+    tc = StubTransferClient()
+    state = open_manifest(manifest_file, "SRC", "DST", items, chunk_size=10)
+    submit_pending_chunks(tc, manifest_file, state)
+    # Crash part way through writing a status record
+    with open(manifest_file, "a") as f:
+        f.write('{"chunk": 0, "status": "SUCC')
+    state = open_manifest(manifest_file, "SRC", "DST", items, chunk_size=10)
+    assert manifest_summary(state)[CHUNK_SUBMITTED] == 3, manifest_summary(state)
+    tc.task_status = {task_id: "SUCCEEDED" for task_id in tc.tasks_by_submission.values()}
+    assert refresh_chunk_status(tc, manifest_file, state)
+    # The record written after the torn one must be readable
+    state = open_manifest(manifest_file, "SRC", "DST", items, chunk_size=10)
+    assert manifest_summary(state)[CHUNK_SUCCEEDED] == 3, manifest_summary(state)
+    assert len(tc.tasks_by_submission) == 3
+    print("Torn last record: OK")
+
+
+def check_crash_between_submit_and_task():
+    manifest_file = os.path.join(tempfile.mkdtemp(), "manifest.jsonl")
+    items = make_items(25)
+    tc = StubTransferClient()
+    state = open_manifest(manifest_file, "SRC", "DST", items, chunk_size=10)
+    tc.fail_after_submit = True
+    try:
+        submit_pending_chunks(tc, manifest_file, state)
+        raise AssertionError("Expected simulated crash")
+    except RuntimeError:
+        pass
+    state = open_manifest(manifest_file, "SRC", "DST", items, chunk_size=10)
+    assert state["chunks"][0]["submission_id"] == "submission-1"
+    assert state["chunks"][0]["task_id"] is None
+    submitted = submit_pending_chunks(tc, manifest_file, state)
+    # First chunk reattaches to the task Globus already created, no new submission id is requested for it
+    assert submitted == ["task-1", "task-2", "task-3"], submitted
+    assert tc.num_submission_ids == 3, tc.num_submission_ids
+    assert len(tc.tasks_by_submission) == 3
+    # A further re-run submits nothing
+    state = open_manifest(manifest_file, "SRC", "DST", items, chunk_size=10)
+    assert submit_pending_chunks(tc, manifest_file, state) == []
+    print("Crash between submit and task records: OK")
+
+
+# ########################################
+# Main
+# ########################################
+if __name__ == "__main__":
+    print("Checking recovery paths of:", txfr_manifest.__file__)
+    check_torn_tail()
+    check_crash_between_submit_and_task()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Cache of endpoint metadata, activation results and directory listings in a state backend (see state_backend.py).
+#
+# Every proxy operation on an endpoint starts by getting the endpoint and auto-activating it, and clients often
+# list the same directories repeatedly. With a backend shared by the replicas of the proxy each of these is
+# fetched from Globus once per time to live, however many requests or replicas need it. Concurrent callers
+# needing the same missing value wait for the one fetching it (single flight).
+#
+# What an endpoint or directory looks like depends on who asks, so entries are kept per requester. The requester
+# is an opaque string, such as the Globus identity Id or a token, and is only stored as a hash.
+#
+# Activation results are kept until shortly before the activation expires. Failed auto-activations are not kept.
+# Listings are kept only briefly and should be invalidated when the directory is changed, e.g. by mkdir or rename.
+#
+import hashlib
+from state_backend import NS_ENDPOINT, NS_ACTIVATION, NS_LISTING
+
+DEFAULT_ENDPOINT_TTL = 3600
+DEFAULT_ACTIVATION_TTL = 3600
+DEFAULT_LISTING_TTL = 10
+# Treat activations expiring within this many seconds as expired
+ACTIVATION_EXPIRY_MARGIN = 300
+
+
+def _requester_hash(requester):
+    """Hash of a requester, so that tokens are never held in the backend."""
+    if requester is None:
+        return ""
+    return hashlib.sha256(requester.encode("utf-8")).hexdigest()
+
+
+def _response_data(response):
+    """Return the JSON data of a Globus response as a dict."""
+    return dict(response.data) if hasattr(response, "data") else dict(response)
+
+
+class EndpointStateCache:
+    """
+    Endpoint metadata, auto-activation results and directory listings for one requester, kept in a state backend.
+    Methods take the TransferClient used to call Globus on a miss and return the response data as a dict.
+    """
+
+    def __init__(self, backend, requester=None, endpoint_ttl=DEFAULT_ENDPOINT_TTL,
+                 activation_ttl=DEFAULT_ACTIVATION_TTL, listing_ttl=DEFAULT_LISTING_TTL):
+        self.backend = backend
+        self.endpoint_ttl = endpoint_ttl
+        self.activation_ttl = activation_ttl
+        self.listing_ttl = listing_ttl
+        self.calls = 0
+        self.misses = 0
+        self._requester_hash = _requester_hash(requester)
+
+    def _key(self, endpoint_id, path=None):
+        if path is None:
+            return "{}:{}".format(self._requester_hash, endpoint_id)
+        return "{}:{}:{}".format(self._requester_hash, endpoint_id, path)
+
+    def _fetch(self, fn):
+        """Wrap a call to Globus so that misses are counted."""
+        def fetch():
+            self.misses += 1
+            return _response_data(fn())
+        return fetch
+
+    def _activation_ttl(self, result):
+        """Time to keep an auto-activation result. 0 for a failed activation."""
+        if result.get("code", "").startswith("AutoActivationFailed"):
+            return 0
+        expires_in = result.get("expires_in", -1)
+        # expires_in is -1 for endpoints whose activation does not expire
+        if expires_in < 0:
+            return self.activation_ttl
+        return max(0, min(self.activation_ttl, expires_in - ACTIVATION_EXPIRY_MARGIN))
+
+    def get_endpoint(self, tc, endpoint_id):
+        """Return the endpoint document."""
+        self.calls += 1
+        return self.backend.single_flight(NS_ENDPOINT, self._key(endpoint_id),
+                                          self._fetch(lambda: tc.get_endpoint(endpoint_id)), ttl=self.endpoint_ttl)
+
+    def autoactivate(self, tc, endpoint_id):
+        """Auto-activate an endpoint, unless it is known to be activated. Return the activation result."""
+        self.calls += 1
+        return self.backend.single_flight(NS_ACTIVATION, self._key(endpoint_id),
+                                          self._fetch(lambda: tc.endpoint_autoactivate(endpoint_id)),
+                                          ttl=self._activation_ttl)
+
+    def invalidate_activation(self, endpoint_id):
+        """Forget the activation of an endpoint, e.g. after Globus reports that activation is required."""
+        self.backend.delete(NS_ACTIVATION, self._key(endpoint_id))
+
+    def operation_ls(self, tc, endpoint_id, path):
+        """Return the listing of a directory. The entries are in the DATA list."""
+        self.calls += 1
+        return self.backend.single_flight(NS_LISTING, self._key(endpoint_id, path),
+                                          self._fetch(lambda: tc.operation_ls(endpoint_id, path=path)),
+                                          ttl=self.listing_ttl)
+
+    def invalidate_listing(self, endpoint_id, path):
+        """Forget the listing of a directory, e.g. after a file in it has been created, renamed or deleted."""
+        self.backend.delete(NS_LISTING, self._key(endpoint_id, path))
+
+    def stats(self):
+        """Return the number of calls and how many of them called Globus."""
+        return {"calls": self.calls, "hits": self.calls - self.misses, "misses": self.misses}
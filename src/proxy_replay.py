@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+#
+# Replay a trace recorded by proxy_trace.py against a Globus proxy, for capacity planning.
+#
+# Requests are issued open loop at the recorded start times, compressed by the speed-up factor, using a
+# fixed size pool of client threads. For each speed-up the report gives offered and achieved throughput,
+# queueing delay (how late each request started compared to its scheduled time) and latency percentiles.
+# Saturation throughput is the highest achieved throughput over all speed-ups.
+#
+# To measure how throughput scales with the number of proxy replicas, give the URL of each replica in
+# --proxy-url and use --scaling. Requests are spread round robin over the replicas, as by a load balancer.
+# The trace is replayed against the first replica, then the first two and so on, and the saturation throughput
+# for each number of replicas is reported with the scaling efficiency: throughput / (replicas * single replica
+# throughput). With linear scaling the efficiency stays near 1. Use enough --concurrency for all the replicas.
+# When the stand-in runs in the same process the number of calls that reached it is also reported, which shows
+# whether replicas sharing a state backend avoid repeating calls to Globus.
+#
+# The proxy under test should talk to a local Globus Transfer stand-in rather than to Globus.
+# Start the stand-in with --standin-port and point the proxy at it. For a proxy built on the Globus
+# python sdk this is done with environment variable:
+#   GLOBUS_SDK_SERVICE_URL_TRANSFER=http://localhost:<port>/
+#
+# Hashed identifiers in the trace are mapped to stable synthetic values: each task hash to a fixed task Id,
+# each path hash to a fixed path of the recorded depth and each requester hash to its own access token.
+# Repeated requests for the same task, path or user in the trace are therefore repeated in the replay.
+#
+# Examples:
+#   # Run only the Globus stand-in with 20ms latency per call
+#   ./proxy_replay.py --standin-port 9090 --standin-latency-ms 20
+#   # Replay a trace at 1x, 4x and 16x against a proxy on localhost:8080
+#   ./proxy_replay.py --trace proxy_trace.jsonl.gz --proxy-url http://localhost:8080 --speeds 1,4,16
+#   # Measure scaling over 1 to 3 replicas, with the stand-in in the same process
+#   ./proxy_replay.py --trace proxy_trace.jsonl.gz --standin-port 9090 --speeds 4,16,64 --concurrency 96 \
+#       --proxy-url http://host1:8080,http://host2:8080,http://host3:8080 --scaling
+#
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+from proxy_trace import read_trace
+
+PROXY_PREFIX = "/v3/globus-proxy"
+# Synthetic token used for records with no requester. The stand-in accepts any token.
+REPLAY_ACCESS_TOKEN = "replay-access-token"
+# Namespace for task Ids derived from task hashes
+REPLAY_TASK_NAMESPACE = uuid.UUID("6f1c8f5e-3b1a-4c51-9b7e-8a4f5d2e9c10")
+DEFAULT_CONCURRENCY = 32
+DEFAULT_TIMEOUT = 30
+
+
+# ########################################
+# Globus Transfer stand-in
+# ########################################
+class GlobusStandinHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the Globus Transfer API. Every call succeeds after a fixed latency.
+    Tasks are always reported as SUCCEEDED. The number of calls received is kept in call_count.
+    """
+    latency = 0.0
+    call_count = 0
+    _count_lock = threading.Lock()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body):
+        time.sleep(self.latency)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        with self._count_lock:
+            type(self).call_count += 1
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        path = re.sub(r"^/v0\.10", "", self.path.split("?")[0]).rstrip("/")
+        if path == "/submission_id":
+            return self._reply({"DATA_TYPE": "submission_id", "value": str(uuid.uuid4())})
+        if path in ("/transfer", "/delete"):
+            return self._reply({"DATA_TYPE": "transfer_result", "code": "Accepted", "task_id": str(uuid.uuid4())})
+        match = re.match(r"^/task/([^/]+)(/cancel)?$", path)
+        if match:
+            if match.group(2):
+                return self._reply({"DATA_TYPE": "result", "code": "TaskComplete",
+                                    "message": "The task completed before the cancel request was processed."})
+            return self._reply({"DATA_TYPE": "task", "task_id": match.group(1), "status": "SUCCEEDED",
+                                "type": "TRANSFER", "files": 1, "files_transferred": 1, "files_skipped": 0,
+                                "faults": 0, "is_ok": True})
+        match = re.match(r"^/operation/endpoint/([^/]+)/(ls|mkdir|rename)$", path)
+        if match:
+            if match.group(2) == "ls":
+                return self._reply({"DATA_TYPE": "file_list", "path": "/~/", "DATA": []})
+            return self._reply({"DATA_TYPE": "result", "code": "OK"})
+        match = re.match(r"^/endpoint/([^/]+)(/autoactivate)?$", path)
+        if match:
+            if match.group(2):
+                return self._reply({"DATA_TYPE": "activation_result", "code": "AlreadyActivated"})
+            return self._reply({"DATA_TYPE": "endpoint", "id": match.group(1), "display_name": "standin",
+                                "default_directory": "/~/"})
+        return self._reply({"DATA_TYPE": "result", "code": "OK"})
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+
+def start_standin(port, latency_ms):
+    """Start the Globus stand-in in a background thread. Return the server."""
+    handler = type("Handler", (GlobusStandinHandler,), {"latency": latency_ms / 1000.0})
+    server = ThreadingHTTPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ########################################
+# Replay
+# ########################################
+def synthetic_path(path_hash, depth):
+    """Stable path of the given depth for a path hash. Distinct hashes give distinct paths."""
+    if depth <= 0:
+        return ""
+    parts = ["dir{}".format(i) for i in range(depth - 1)]
+    parts.append("d_" + path_hash if path_hash else "dir{}".format(depth - 1))
+    return "/".join(parts)
+
+
+def synthetic_task_id(task_hash):
+    """Stable task Id for a task hash, or a new random Id if there is no hash."""
+    if not task_hash:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(REPLAY_TASK_NAMESPACE, task_hash))
+
+
+def build_request(proxy_url, rec):
+    """Build an HTTP request for the proxy from a trace record. Return (method, url, body)."""
+    op = rec["op"]
+    ep = rec.get("ep") or "standin"
+    path = synthetic_path(rec.get("p"), rec.get("d") or 0)
+    num_items = rec.get("n") or 1
+    access_token = "replay-token-" + rec["u"] if rec.get("u") else REPLAY_ACCESS_TOKEN
+    token = "?access_token=" + access_token
+    base = proxy_url.rstrip("/") + PROXY_PREFIX
+    task_id = synthetic_task_id(rec.get("tk"))
+    if op == "healthCheck":
+        return "GET", base + "/healthcheck", None
+    if op == "getAuthUrl":
+        return "GET", base + "/auth/url/replay-client", None
+    if op == "getTokens":
+        return "GET", base + "/auth/tokens/replay-auth-code", None
+    if op == "checkTokens":
+        return "GET", "{}/auth/check_tokens/{}{}&refresh_token={}".format(base, ep, token,
+                                                                          access_token + "-refresh"), None
+    if op == "listFiles":
+        return "GET", "{}/ops/{}/{}{}".format(base, ep, quote(path or "."), token), None
+    if op == "deletePath":
+        return "DELETE", "{}/ops/{}/{}{}".format(base, ep, quote(path or "."), token), None
+    if op == "makeDir":
+        return "POST", "{}/ops/{}/mkdir{}".format(base, ep, token), {"path": path}
+    if op == "renamePath":
+        return "POST", "{}/ops/{}/rename{}".format(base, ep, token), {"source_path": path + "/a",
+                                                                       "destination_path": path + "/b"}
+    if op == "createTransferTask":
+        items = [{"source_path": "{}/file{}".format(path, i), "destination_path": "{}/file{}".format(path, i),
+                  "recursive": False} for i in range(num_items)]
+        return "POST", base + "/transfers" + token, {"transfer_items": items}
+    if op == "getTransferTask":
+        return "GET", "{}/transfers/{}{}".format(base, task_id, token), None
+    if op == "cancelTransferTask":
+        return "DELETE", "{}/transfers/{}{}".format(base, task_id, token), None
+    raise ValueError("Unknown operation in trace: {}".format(op))
+
+
+def _issue(method, url, body, scheduled, timeout):
+    """Make one request. Return (scheduled, started, finished, ok)."""
+    started = time.perf_counter()
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    ok = True
+    try:
+        with urlopen(req, timeout=timeout) as resp:
+            resp.read()
+    except HTTPError as ex:
+        ex.read()
+        ok = ex.code < 500
+    except (URLError, OSError):
+        ok = False
+    return scheduled, started, time.perf_counter(), ok
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def replay(records, proxy_urls, speed, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+    """
+    Replay trace records at the given speed-up. Return a dict of results.
+    proxy_urls is the base URL of the proxy, or a list of URLs of replicas to spread requests over round robin.
+    """
+    if not records:
+        raise ValueError("Trace contains no records.")
+    if isinstance(proxy_urls, str):
+        proxy_urls = [proxy_urls]
+    requests = [build_request(proxy_urls[i % len(proxy_urls)], rec) for i, rec in enumerate(records)]
+    t0 = records[0]["t"]
+    offsets = [(rec["t"] - t0) / speed for rec in records]
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        futures = []
+        for offset, (method, url, body) in zip(offsets, requests):
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(_issue, method, url, body, scheduled, timeout))
+        results = [f.result() for f in futures]
+    end = max(r[2] for r in results)
+    queue_delays = [max(0.0, r[1] - r[0]) * 1000.0 for r in results]
+    latencies = [(r[2] - r[1]) * 1000.0 for r in results]
+    duration = end - start
+    trace_span = offsets[-1] if offsets[-1] > 0 else duration
+    return {
+        "speed": speed,
+        "replicas": len(proxy_urls),
+        "requests": len(results),
+        "errors": sum(1 for r in results if not r[3]),
+        "offered_rps": round(len(results) / trace_span, 2) if trace_span > 0 else None,
+        "achieved_rps": round(len(results) / duration, 2) if duration > 0 else None,
+        "queue_delay_ms_p50": round(_percentile(queue_delays, 50), 2),
+        "queue_delay_ms_p99": round(_percentile(queue_delays, 99), 2),
+        "queue_delay_ms_max": round(max(queue_delays), 2),
+        "latency_ms_p50": round(_percentile(latencies, 50), 2),
+        "latency_ms_p95": round(_percentile(latencies, 95), 2),
+        "latency_ms_p99": round(_percentile(latencies, 99), 2),
+        "latency_ms_max": round(max(latencies), 2),
+    }
+
+
+# ########################################
+# Main
+# ########################################
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Globus proxy trace for capacity planning.")
+    parser.add_argument("--trace", help="Trace file written by proxy_trace.TraceRecorder")
+    parser.add_argument("--proxy-url", default="http://localhost:8080",
+                        help="Base URL of the proxy under test, or comma separated URLs of its replicas")
+    parser.add_argument("--scaling", action="store_true",
+                        help="Measure saturation throughput using 1, 2, ... up to all of the replicas")
+    parser.add_argument("--speeds", default="1", help="Comma separated list of speed-up factors, e.g. 1,2,4,8")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Number of client threads")
+    parser.add_argument("--standin-port", type=int, help="Start a Globus Transfer stand-in on this port")
+    parser.add_argument("--standin-latency-ms", type=float, default=0.0, help="Latency of each stand-in call")
+    args = parser.parse_args()
+
+    standin = None
+    if args.standin_port:
+        standin = start_standin(args.standin_port, args.standin_latency_ms)
+        print("Globus stand-in listening on port:", args.standin_port)
+        print("Point the proxy at it using: GLOBUS_SDK_SERVICE_URL_TRANSFER=http://localhost:{}/"
+              .format(args.standin_port))
+    if not args.trace:
+        if not args.standin_port:
+            sys.exit("Error. Either --trace or --standin-port must be given.")
+        while True:
+            time.sleep(3600)
+
+    records = read_trace(args.trace)
+    print("Replaying trace: {} Requests: {}".format(args.trace, len(records)))
+    print("============================================================================================")
+    replica_urls = args.proxy_url.split(",")
+    replica_counts = range(1, len(replica_urls) + 1) if args.scaling else [len(replica_urls)]
+    saturations = []
+    for num_replicas in replica_counts:
+        reports = []
+        for speed in [float(s) for s in args.speeds.split(",")]:
+            calls_before = standin.RequestHandlerClass.call_count if standin else 0
+            report = replay(records, replica_urls[:num_replicas], speed, concurrency=args.concurrency)
+            if standin:
+                report["globus_calls"] = standin.RequestHandlerClass.call_count - calls_before
+            reports.append(report)
+            print(json.dumps(report, indent=2, sort_keys=True))
+            print("============================================================================================")
+        saturation = max(reports, key=lambda r: r["achieved_rps"] or 0)
+        saturations.append(saturation)
+        print("Saturation throughput with {} replicas: {} requests/sec at speed-up {}"
+              .format(num_replicas, saturation["achieved_rps"], saturation["speed"]))
+        print("============================================================================================")
+    if len(saturations) > 1:
+        print("Scaling:")
+        base_rps = saturations[0]["achieved_rps"] or 0
+        for saturation in saturations:
+            efficiency = saturation["achieved_rps"] / (saturation["replicas"] * base_rps) if base_rps else None
+            print("  replicas: {} saturation requests/sec: {} efficiency: {}".format(
+                saturation["replicas"], saturation["achieved_rps"],
+                round(efficiency, 2) if efficiency is not None else None))
+
+
+if __name__ == "__main__":
+    main()
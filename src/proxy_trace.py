@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#
+# Recording of sanitized Globus proxy traffic for capacity planning. See proxy_replay.py for replay.
+#
+# Each request is written as one compact JSON record in a gzip file. Nothing that identifies users or data
+# is kept: endpoint Ids, task Ids, paths and the requester (access token or Globus identity) are replaced by
+# a short salted hash. The hashes keep the reuse pattern of the workload, e.g. the same task polled many times
+# or the same directory listed repeatedly, so the replay exercises caches and per-identity limits realistically.
+# The salt is random for each TraceRecorder unless one is given. Give the same secret salt to keep hashes
+# consistent across runs appending to one trace.
+# Record keys:
+#   t   - start time of the request, seconds since the epoch
+#   op  - operationId from GlobusProxyAPI.yaml, e.g. listFiles, createTransferTask
+#   ep  - hashed endpoint Id, or null
+#   tk  - hashed task Id, or null. For createTransferTask the Id of the task created.
+#   u   - hashed requester, or null
+#   p   - hashed path, or null
+#   d   - path depth, e.g. 2 for /dirA/dirB/, or null
+#   n   - number of items, e.g. transfer items or files listed, or null
+#   ms  - duration in milliseconds
+#   st  - result, "ok" or the HTTP status of an error
+#
+import atexit
+import gzip
+import hashlib
+import json
+import secrets
+import threading
+import time
+
+# Operation Ids from GlobusProxyAPI.yaml
+OP_HEALTH_CHECK = "healthCheck"
+OP_GET_AUTH_URL = "getAuthUrl"
+OP_GET_TOKENS = "getTokens"
+OP_CHECK_TOKENS = "checkTokens"
+OP_LIST_FILES = "listFiles"
+OP_DELETE_PATH = "deletePath"
+OP_MAKE_DIR = "makeDir"
+OP_RENAME_PATH = "renamePath"
+OP_CREATE_TRANSFER_TASK = "createTransferTask"
+OP_GET_TRANSFER_TASK = "getTransferTask"
+OP_CANCEL_TRANSFER_TASK = "cancelTransferTask"
+
+# TransferClient methods and the proxy operation they correspond to
+TRANSFER_CLIENT_OPERATIONS = {
+    "operation_ls": OP_LIST_FILES,
+    "submit_delete": OP_DELETE_PATH,
+    "operation_mkdir": OP_MAKE_DIR,
+    "operation_rename": OP_RENAME_PATH,
+    "submit_transfer": OP_CREATE_TRANSFER_TASK,
+    "get_task": OP_GET_TRANSFER_TASK,
+    "cancel_task": OP_CANCEL_TRANSFER_TASK,
+}
+
+
+def salted_hash(salt, value):
+    """Short salted hash of an identifier. Stable for a given salt."""
+    if value is None:
+        return None
+    return hashlib.sha256((salt + "\0" + value).encode("utf-8")).hexdigest()[:12]
+
+
+def path_depth(path):
+    """Number of components in a path, e.g. 2 for /dirA/dirB/"""
+    if path is None:
+        return None
+    return len([p for p in path.split("/") if p and p != "~"])
+
+
+class TraceRecorder:
+    """
+    Append sanitized request records to a gzip'd JSON lines trace file.
+    The file is closed at exit if close() has not been called, so that buffered records are written.
+    """
+
+    def __init__(self, trace_path, salt=None):
+        self.trace_path = trace_path
+        self._salt = salt if salt is not None else secrets.token_hex(16)
+        self._lock = threading.Lock()
+        self._file = gzip.open(trace_path, "at")
+        atexit.register(self.close)
+
+    def record(self, operation_id, start_time, duration, endpoint_id=None, path=None, item_count=None,
+               status="ok", task_id=None, requester=None):
+        """Record one request. start_time is seconds since the epoch and duration is in seconds."""
+        rec = {"t": round(start_time, 4), "op": operation_id, "ep": salted_hash(self._salt, endpoint_id),
+               "tk": salted_hash(self._salt, task_id), "u": salted_hash(self._salt, requester),
+               "p": salted_hash(self._salt, path), "d": path_depth(path), "n": item_count,
+               "ms": round(duration * 1000.0, 2), "st": status}
+        line = json.dumps(rec, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_trace(trace_path):
+    """Return the records of a trace file, sorted by start time."""
+    with gzip.open(trace_path, "rt") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda rec: rec["t"])
+    return records
+
+
+def _call_details(method_name, args, kwargs):
+    """Pull endpoint, task Id, path and item count out of a TransferClient call."""
+    endpoint_id = args[0] if args and isinstance(args[0], str) else kwargs.get("endpoint_id")
+    task_id = None
+    path = kwargs.get("path", kwargs.get("oldpath"))
+    item_count = None
+    if method_name in ("submit_transfer", "submit_delete"):
+        data = args[0] if args else kwargs.get("data")
+        endpoint_id = data.get("source_endpoint", data.get("endpoint"))
+        item_count = len(data.get("DATA", []))
+    elif method_name in ("get_task", "cancel_task"):
+        endpoint_id = None
+        task_id = args[0] if args else kwargs.get("task_id")
+    return endpoint_id, task_id, path, item_count
+
+
+class RecordingTransferClient:
+    """
+    Wrap a TransferClient so that calls corresponding to proxy operations are recorded.
+    requester identifies who the calls are made for, e.g. the access token or Globus identity Id.
+    All other attributes are passed through unchanged.
+    """
+
+    def __init__(self, tc, recorder, requester=None):
+        self._tc = tc
+        self._recorder = recorder
+        self._requester = requester
+
+    def __getattr__(self, name):
+        attr = getattr(self._tc, name)
+        operation_id = TRANSFER_CLIENT_OPERATIONS.get(name)
+        if operation_id is None or not callable(attr):
+            return attr
+
+        def recorded_call(*args, **kwargs):
+            endpoint_id, task_id, path, item_count = _call_details(name, args, kwargs)
+            status = "ok"
+            start_time = time.time()
+            start = time.perf_counter()
+            try:
+                response = attr(*args, **kwargs)
+                if name == "operation_ls":
+                    item_count = len(response["DATA"])
+                elif name in ("submit_transfer", "submit_delete"):
+                    task_id = response["task_id"]
+                return response
+            except Exception as ex:
+                status = getattr(ex, "http_status", "error")
+                raise
+            finally:
+                self._recorder.record(operation_id, start_time, time.perf_counter() - start, endpoint_id=endpoint_id,
+                                      path=path, item_count=item_count, status=status, task_id=task_id,
+                                      requester=self._requester)
+        return recorded_call
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# Client side rate limiting of calls to Globus.
+#
+# Bursts of operation_ls, get_task and submit_transfer from many users get throttled by Globus, slowing
+# every request through the proxy. Calls are instead smoothed before they reach Globus using token buckets
+# per Globus identity, per endpoint and per operation class. A call is admitted once every bucket that
+# applies to it has a token.
+#
+# Waiting calls are queued per Tapis tenant and tenants take turns, so one tenant with a large burst
+# cannot starve the others. Within a tenant calls are queued per Globus identity and identities take turns.
+# Calls of one identity are admitted in order, but a call whose buckets have tokens is never held back by a call
+# of another identity or tenant that is still waiting on its own buckets.
+#
+# Admission delay for each operation class is available from RateLimiter.metrics().
+#
+# Limits are a dict of (rate per second, burst) tuples, for example:
+#   {
+#       "identity": (10, 20),
+#       "identity_overrides": {"<identity id>": (50, 100)},
+#       "endpoint": (20, 40),
+#       "endpoint_overrides": {"<endpoint id>": (5, 5)},
+#       "op_class": {OP_CLASS_LS: (20, 40), OP_CLASS_TASK: (50, 100), OP_CLASS_SUBMIT: (2, 5)},
+#   }
+# Any entry may be left out, in which case that level is not limited.
+# Each rate must be greater than zero and each burst at least 1, otherwise ValueError is raised.
+#
+# Bucket state is held in the RateLimiter, so each replica of the proxy has its own limits. With N replicas behind
+# a load balancer the total rate reaching Globus can be up to N times the configured rate, so configure each
+# replica with its share, e.g. the rate Globus allows divided by the number of replicas.
+#
+import collections
+import threading
+import time
+
+# Operation classes
+OP_CLASS_LS = "ls"
+OP_CLASS_TASK = "task"
+OP_CLASS_SUBMIT = "submit"
+
+# TransferClient methods and their operation class
+TRANSFER_CLIENT_OP_CLASSES = {
+    "operation_ls": OP_CLASS_LS,
+    "operation_mkdir": OP_CLASS_LS,
+    "operation_rename": OP_CLASS_LS,
+    "get_task": OP_CLASS_TASK,
+    "cancel_task": OP_CLASS_TASK,
+    "task_list": OP_CLASS_TASK,
+    "submit_transfer": OP_CLASS_SUBMIT,
+    "submit_delete": OP_CLASS_SUBMIT,
+}
+
+DEFAULT_TENANT = "default"
+# Number of recent admission delays kept per operation class for percentiles
+METRICS_SAMPLES = 1000
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second up to burst tokens. Not thread safe on its own."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available. Zero if one is available now."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+def _check_limit(name, limit):
+    """Raise ValueError unless limit is a (rate, burst) pair that can admit calls."""
+    rate, burst = limit
+    if rate <= 0:
+        raise ValueError("Rate limit for {} must be greater than 0. Got: {}".format(name, rate))
+    if burst < 1:
+        raise ValueError("Burst for {} must be at least 1. Got: {}".format(name, burst))
+
+
+class _Ticket:
+    """A call waiting for admission."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.admitted = False
+        self.enqueued = time.monotonic()
+
+
+class RateLimiter:
+    """Token bucket rate limiter with fair queueing across tenants. Thread safe."""
+
+    def __init__(self, limits):
+        for level in ("identity", "endpoint"):
+            if limits.get(level) is not None:
+                _check_limit(level, limits[level])
+            for key, limit in limits.get(level + "_overrides", {}).items():
+                _check_limit("{} {}".format(level, key), limit)
+        for op_class, limit in limits.get("op_class", {}).items():
+            _check_limit("op_class {}".format(op_class), limit)
+        self.limits = limits
+        self._buckets = {}
+        self._cond = threading.Condition()
+        # Waiting tickets per tenant and identity, and the order in which tenants take turns.
+        # The identities of a tenant are kept in the order in which they take turns.
+        self._queues = {}
+        self._turns = collections.deque()
+        self._delays = {}
+
+    def _bucket(self, level, key):
+        """Return the bucket for a level and key, or None if that level is not limited."""
+        if level == "op_class":
+            limit = self.limits.get("op_class", {}).get(key)
+        else:
+            limit = self.limits.get(level + "_overrides", {}).get(key, self.limits.get(level))
+        if limit is None:
+            return None
+        bucket = self._buckets.get((level, key))
+        if bucket is None:
+            bucket = self._buckets[(level, key)] = TokenBucket(*limit)
+        return bucket
+
+    def _next_ready(self, tenant, now):
+        """
+        Return (identity, 0.0) for the first identity of a tenant, in turn order, whose next call may be admitted now.
+        Otherwise return (None, wait), where wait is the time until one of them may be.
+        """
+        min_wait = None
+        for identity, tickets in self._queues[tenant].items():
+            wait = max([b.wait_time(now) for b in tickets[0].buckets] or [0.0])
+            if wait == 0:
+                return identity, 0.0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    def _dispatch(self):
+        """
+        Admit waiting calls, visiting tenants in turn order and looking at the first call of each identity.
+        Return the number of calls admitted and the time to wait before another call could be admitted,
+        or None if nothing is waiting.
+        """
+        admitted = 0
+        min_wait = None
+        progress = True
+        while progress and self._turns:
+            progress = False
+            now = time.monotonic()
+            min_wait = None
+            for tenant in list(self._turns):
+                identity, wait = self._next_ready(tenant, now)
+                if wait > 0:
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+                    continue
+                identities = self._queues[tenant]
+                ticket = identities[identity].popleft()
+                for bucket in ticket.buckets:
+                    bucket.take()
+                ticket.admitted = True
+                admitted += 1
+                # Identity and tenant go to the back of the line, or leave it if nothing else is waiting
+                if identities[identity]:
+                    identities.move_to_end(identity)
+                else:
+                    del identities[identity]
+                self._turns.remove(tenant)
+                if identities:
+                    self._turns.append(tenant)
+                else:
+                    del self._queues[tenant]
+                progress = True
+                break
+        return admitted, min_wait
+
+    def acquire(self, op_class, identity=None, endpoint_id=None, tenant=DEFAULT_TENANT):
+        """Block until a call may be made. Return the admission delay in seconds."""
+        with self._cond:
+            buckets = [b for b in (self._bucket("identity", identity) if identity else None,
+                                   self._bucket("endpoint", endpoint_id) if endpoint_id else None,
+                                   self._bucket("op_class", op_class)) if b is not None]
+            ticket = _Ticket(buckets)
+            if tenant not in self._queues:
+                self._queues[tenant] = collections.OrderedDict()
+                self._turns.append(tenant)
+            self._queues[tenant].setdefault(identity, collections.deque()).append(ticket)
+            while True:
+                admitted, min_wait = self._dispatch()
+                if admitted:
+                    # Wake the callers whose calls were admitted
+                    self._cond.notify_all()
+                if ticket.admitted:
+                    break
+                self._cond.wait(min_wait)
+            delay = time.monotonic() - ticket.enqueued
+            stats = self._delays.get(op_class)
+            if stats is None:
+                stats = self._delays[op_class] = {"count": 0, "total": 0.0, "max": 0.0,
+                                                  "recent": collections.deque(maxlen=METRICS_SAMPLES)}
+            stats["count"] += 1
+            stats["total"] += delay
+            stats["max"] = max(stats["max"], delay)
+            stats["recent"].append(delay)
+        return delay
+
+    def metrics(self):
+        """Return admission delay metrics, in milliseconds, per operation class."""
+        result = {}
+        with self._cond:
+            for op_class, stats in self._delays.items():
+                recent = sorted(stats["recent"])
+                result[op_class] = {
+                    "count": stats["count"],
+                    "delay_ms_mean": round(stats["total"] / stats["count"] * 1000.0, 3),
+                    "delay_ms_max": round(stats["max"] * 1000.0, 3),
+                    "delay_ms_p50": round(recent[int(0.50 * (len(recent) - 1))] * 1000.0, 3),
+                    "delay_ms_p99": round(recent[int(0.99 * (len(recent) - 1))] * 1000.0, 3),
+                }
+            result["waiting"] = sum(len(q) for identities in self._queues.values() for q in identities.values())
+        return result
+
+
+class RateLimitedTransferClient:
+    """
+    Wrap a TransferClient so that calls are admitted by a RateLimiter before being made.
+    identity is the Globus identity the client acts for and tenant is the Tapis tenant.
+    task_wait() polls with get_task() through the limiter.
+    """
+
+    def __init__(self, tc, limiter, identity=None, tenant=DEFAULT_TENANT):
+        self._tc = tc
+        self._limiter = limiter
+        self._identity = identity
+        self._tenant = tenant
+
+    def __getattr__(self, name):
+        attr = getattr(self._tc, name)
+        op_class = TRANSFER_CLIENT_OP_CLASSES.get(name)
+        if op_class is None or not callable(attr):
+            return attr
+
+        def limited_call(*args, **kwargs):
+            endpoint_id = None
+            if op_class == OP_CLASS_LS:
+                endpoint_id = args[0] if args else kwargs.get("endpoint_id")
+            elif op_class == OP_CLASS_SUBMIT:
+                data = args[0] if args else kwargs.get("data")
+                endpoint_id = data.get("source_endpoint", data.get("endpoint"))
+            self._limiter.acquire(op_class, identity=self._identity, endpoint_id=endpoint_id, tenant=self._tenant)
+            return attr(*args, **kwargs)
+        return limited_call
+
+    def task_wait(self, task_id, timeout=10, polling_interval=10):
+        """
+        Wait for a task to finish, as TransferClient.task_wait() does, but with each get_task() call rate limited.
+        Return True if the task is no longer ACTIVE within timeout seconds, otherwise False.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.get_task(task_id)["status"] != "ACTIVE":
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(polling_interval, remaining))
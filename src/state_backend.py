@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# Pluggable state backends so that several proxy replicas can share cached state.
+#
+# State kept per process (endpoint metadata, activation state, token state, listing caches, task tracking)
+# means each replica behind a load balancer re-fetches, re-activates and re-polls the same things.
+# A backend stores JSON values by namespace and key, with an optional time to live, and provides
+# single_flight() so that when many callers need the same missing value only one of them computes it.
+#
+# Three implementations:
+#   InProcessBackend - dict in memory. Single flight across threads of one process.
+#   SqliteBackend    - SQLite database file shared by replicas running on one host.
+#                      Single flight across processes using a lock table.
+#                      The database uses WAL mode, which needs memory shared between the processes using it,
+#                      so it must be on a local disk and cannot be shared across hosts, e.g. over NFS.
+#   RedisBackend     - Redis, or any server speaking the Redis protocol, shared by replicas on any number of hosts.
+#                      Single flight using a lock key with an expiry. Needs the redis package.
+#
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Namespaces
+NS_ENDPOINT = "endpoint"
+NS_ACTIVATION = "activation"
+NS_TOKEN = "token"
+NS_IDENTITY = "identity"
+NS_LISTING = "listing"
+NS_TASK = "task"
+NS_TASK_STATUS = "task_status"
+
+DEFAULT_LOCK_TIMEOUT = 30
+DEFAULT_POLL_INTERVAL = 0.05
+
+
+def _value_ttl(ttl, value):
+    """ttl for a value computed by single_flight(). ttl is a number, None or a function of the value."""
+    return ttl(value) if callable(ttl) else ttl
+
+
+class StateBackend:
+    """Interface for state backends. Values must be JSON serializable."""
+
+    def get(self, namespace, key):
+        """Return the value for a key, or None if missing or expired."""
+        raise NotImplementedError()
+
+    def set(self, namespace, key, value, ttl=None):
+        """Store a value. If ttl is given the value expires after ttl seconds."""
+        raise NotImplementedError()
+
+    def delete(self, namespace, key):
+        """Remove a value."""
+        raise NotImplementedError()
+
+    def single_flight(self, namespace, key, fn, ttl=None, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        """
+        Return the value for a key. If it is missing, call fn() to compute it and store it with the given ttl.
+        ttl may also be a function taking the computed value and returning its ttl, e.g. 0 for a value not to keep.
+        Concurrent callers for the same key wait for the one computing the value instead of calling fn() too.
+        If fn() raises, the exception is raised to that caller only and another caller may then try.
+        """
+        raise NotImplementedError()
+
+
+# ########################################
+# In process backend
+# ########################################
+class InProcessBackend(StateBackend):
+    """
+    Backend holding state in memory. Suitable for a single replica.
+    Values are held as JSON, as in the other backends, so callers get a copy they may change.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def get(self, namespace, key):
+        with self._lock:
+            item = self._values.get((namespace, key))
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and time.time() >= expires_at:
+                del self._values[(namespace, key)]
+                return None
+        return json.loads(value)
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        value = json.dumps(value)
+        with self._lock:
+            self._values[(namespace, key)] = (value, expires_at)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._values.pop((namespace, key), None)
+
+    def single_flight(self, namespace, key, fn, ttl=None, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        while True:
+            value = self.get(namespace, key)
+            if value is not None:
+                return value
+            with self._lock:
+                flight = self._flights.get((namespace, key))
+                leader = flight is None
+                if leader:
+                    flight = self._flights[(namespace, key)] = threading.Event()
+            if not leader:
+                flight.wait(lock_timeout)
+                continue
+            try:
+                value = fn()
+                if value is not None:
+                    self.set(namespace, key, value, _value_ttl(ttl, value))
+                return value
+            finally:
+                with self._lock:
+                    del self._flights[(namespace, key)]
+                flight.set()
+
+
+# ########################################
+# SQLite backend
+# ########################################
+class SqliteBackend(StateBackend):
+    """
+    Backend holding state in a SQLite database file shared by replicas on the same host.
+    The database uses WAL mode so readers do not block the writer. db_path must be on a local filesystem.
+    """
+
+    def __init__(self, db_path, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.owner_id = str(uuid.uuid4())
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS state (ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                     " expires_at REAL, PRIMARY KEY (ns, key))")
+        conn.execute("CREATE TABLE IF NOT EXISTS locks (ns TEXT NOT NULL, key TEXT NOT NULL, owner TEXT NOT NULL,"
+                     " expires_at REAL NOT NULL, PRIMARY KEY (ns, key))")
+        conn.commit()
+
+    def _conn(self):
+        """Return the connection for the current thread. sqlite3 connections may not be shared across threads."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        row = self._conn().execute("SELECT value, expires_at FROM state WHERE ns = ? AND key = ?",
+                                   (namespace, key)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and time.time() >= expires_at:
+            self._conn().execute("DELETE FROM state WHERE ns = ? AND key = ? AND expires_at <= ?",
+                                 (namespace, key, time.time()))
+            return None
+        return json.loads(value)
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._conn().execute("INSERT OR REPLACE INTO state (ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                             (namespace, key, json.dumps(value), expires_at))
+
+    def delete(self, namespace, key):
+        self._conn().execute("DELETE FROM state WHERE ns = ? AND key = ?", (namespace, key))
+
+    def _try_lock(self, namespace, key, owner, lock_timeout):
+        """Try to take the lock for a key. An expired lock, e.g. left by a crashed replica, is taken over."""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM locks WHERE ns = ? AND key = ? AND expires_at <= ?", (namespace, key, now))
+            cur = conn.execute("INSERT OR IGNORE INTO locks (ns, key, owner, expires_at) VALUES (?, ?, ?, ?)",
+                               (namespace, key, owner, now + lock_timeout))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount == 1
+
+    def _unlock(self, namespace, key, owner):
+        self._conn().execute("DELETE FROM locks WHERE ns = ? AND key = ? AND owner = ?", (namespace, key, owner))
+
+    def single_flight(self, namespace, key, fn, ttl=None, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        # Each call has its own owner so that threads within a replica are also coordinated
+        owner = "{}:{}".format(self.owner_id, uuid.uuid4())
+        while True:
+            value = self.get(namespace, key)
+            if value is not None:
+                return value
+            if self._try_lock(namespace, key, owner, lock_timeout):
+                try:
+                    # Another caller may have stored the value between our get and taking the lock
+                    value = self.get(namespace, key)
+                    if value is not None:
+                        return value
+                    value = fn()
+                    if value is not None:
+                        self.set(namespace, key, value, _value_ttl(ttl, value))
+                    return value
+                finally:
+                    self._unlock(namespace, key, owner)
+            time.sleep(self.poll_interval)
+
+
+# ########################################
+# Redis backend
+# ########################################
+# Release a lock only if it is still held by the caller, so an expired lock taken over by another caller is kept
+_UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisBackend(StateBackend):
+    """
+    Backend holding state in Redis, shared by replicas on any number of hosts.
+    Keys are prefixed with key_prefix, so that one Redis database can be used for several purposes.
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, key_prefix="globus-proxy:",
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        if redis is None:
+            raise RuntimeError("RedisBackend needs the redis package. Install it with: pip install redis")
+        self.key_prefix = key_prefix
+        self.poll_interval = poll_interval
+        self.owner_id = str(uuid.uuid4())
+        # redis.Redis keeps a thread safe pool of connections
+        self._redis = redis.Redis(host=host, port=port, db=db, password=password)
+        self._unlock_script = self._redis.register_script(_UNLOCK_SCRIPT)
+
+    def _key(self, namespace, key):
+        return "{}{}:{}".format(self.key_prefix, namespace, key)
+
+    def get(self, namespace, key):
+        value = self._redis.get(self._key(namespace, key))
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, namespace, key, value, ttl=None):
+        if ttl is None:
+            self._redis.set(self._key(namespace, key), json.dumps(value))
+        elif ttl <= 0:
+            # Redis does not accept an expiry of 0. The value would expire immediately, so is not stored.
+            self._redis.delete(self._key(namespace, key))
+        else:
+            self._redis.set(self._key(namespace, key), json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def delete(self, namespace, key):
+        self._redis.delete(self._key(namespace, key))
+
+    def single_flight(self, namespace, key, fn, ttl=None, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        lock_key = self._key("lock:" + namespace, key)
+        # Each call has its own owner so that threads within a replica are also coordinated
+        owner = "{}:{}".format(self.owner_id, uuid.uuid4())
+        while True:
+            value = self.get(namespace, key)
+            if value is not None:
+                return value
+            # The lock expires after lock_timeout, so a lock left by a crashed replica is eventually released
+            if self._redis.set(lock_key, owner, nx=True, px=int(lock_timeout * 1000)):
+                try:
+                    # Another caller may have stored the value between our get and taking the lock
+                    value = self.get(namespace, key)
+                    if value is not None:
+                        return value
+                    value = fn()
+                    if value is not None:
+                        self.set(namespace, key, value, _value_ttl(ttl, value))
+                    return value
+                finally:
+                    self._unlock_script(keys=[lock_key], args=[owner])
+            time.sleep(self.poll_interval)
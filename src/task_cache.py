@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# Cache for Globus tasks that have reached a terminal state.
+#
+# Once a task has status SUCCEEDED or FAILED (a cancelled task ends up FAILED with fatal_error code CANCELED)
+# the task document returned by get_task never changes. The same is true of the result of a cancel request
+# for such a task. Those are kept in an in memory LRU and optionally in a directory on disk, so that repeated
+# status checks and cancels for finished tasks can be answered without calling Globus.
+#
+# A shared state backend (see state_backend.py) may be given so that replicas of the proxy share the cache.
+# With a backend, concurrent status checks of a task not yet cached as terminal are combined: one caller gets the
+# task from Globus and the others use its result, which is also kept for poll_ttl seconds for the same requester.
+#
+# Task documents are only returned to a requester that has previously been able to retrieve the task from
+# Globus. The requester is an opaque string, such as the access token, and is stored only as a hash.
+#
+import collections
+import hashlib
+import json
+import os
+import threading
+from state_backend import NS_TASK, NS_TASK_STATUS
+
+# Task status values for which the task document no longer changes. See GlobusTaskStatusEnum
+TERMINAL_TASK_STATUSES = ("SUCCEEDED", "FAILED")
+# Cancel result codes returned for a task that is no longer active. See GlobusTaskCancelEnum
+# Once either has been returned, any later cancel request gets TaskComplete from Globus.
+TERMINAL_CANCEL_CODES = ("TaskComplete", "Canceled")
+
+DEFAULT_MAX_ENTRIES = 10000
+# How long entries are kept in a shared state backend
+DEFAULT_BACKEND_TTL = 7 * 24 * 3600
+# How long a task document for a task that is still active may be shared in the backend
+DEFAULT_POLL_TTL = 2
+
+
+def _requester_hash(requester):
+    """Hash of a requester, so that tokens are never held in the cache or written to disk."""
+    if requester is None:
+        return None
+    return hashlib.sha256(requester.encode("utf-8")).hexdigest()
+
+
+def _task_complete_result(task_id):
+    """Cancel result Globus returns for a task that is no longer active."""
+    return {
+        "DATA_TYPE": "result",
+        "code": "TaskComplete",
+        "message": "The task completed before the cancel request was processed.",
+        "resource": "/task/{}/cancel".format(task_id),
+    }
+
+
+def _response_data(response):
+    """Return the JSON data of a Globus response as a dict."""
+    return dict(response.data) if hasattr(response, "data") else dict(response)
+
+
+class TerminalTaskCache:
+    """
+    LRU cache of terminal task documents and cancel results, keyed by task Id.
+    If cache_dir is given, entries are also written there and survive a restart.
+    If backend is given, entries are also stored there and shared with other users of the backend.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_dir=None, backend=None,
+                 backend_ttl=DEFAULT_BACKEND_TTL, poll_ttl=DEFAULT_POLL_TTL):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.backend_ttl = backend_ttl
+        self.poll_ttl = poll_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    # ----------------------------------------------------------------------------------
+    # Lookup and storage
+    # ----------------------------------------------------------------------------------
+    def _entry_path(self, task_id):
+        # Task ids are UUIDs. Reject anything that could escape the cache directory.
+        if not task_id or "/" in task_id or task_id.startswith("."):
+            return None
+        return os.path.join(self.cache_dir, task_id + ".json")
+
+    def _lookup(self, task_id):
+        """Return the cache entry for a task, checking memory, then the shared backend, then disk."""
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is not None:
+                self._entries.move_to_end(task_id)
+                return entry
+        if self.backend is not None:
+            entry = self.backend.get(NS_TASK, task_id)
+            if entry is not None:
+                entry["requesters"] = set(entry["requesters"])
+                self._remember(task_id, entry)
+                return entry
+        if self.cache_dir is None:
+            return None
+        path = self._entry_path(task_id)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        entry["requesters"] = set(entry["requesters"])
+        self._remember(task_id, entry)
+        return entry
+
+    def _remember(self, task_id, entry):
+        with self._lock:
+            self._entries[task_id] = entry
+            self._entries.move_to_end(task_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _store(self, task_id, entry):
+        """Save an entry in memory and, if configured, in the shared backend and on disk."""
+        self._remember(task_id, entry)
+        data = dict(entry)
+        data["requesters"] = sorted(entry["requesters"], key=lambda r: r or "")
+        if self.backend is not None:
+            self.backend.set(NS_TASK, task_id, data, ttl=self.backend_ttl)
+        if self.cache_dir is None:
+            return
+        path = self._entry_path(task_id)
+        if path is None:
+            return
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _cached(self, task_id, requester):
+        """Return the entry for the task if it is cached and the requester may see it."""
+        entry = self._lookup(task_id)
+        if entry is None:
+            return None
+        if _requester_hash(requester) not in entry["requesters"]:
+            return None
+        return entry
+
+    # ----------------------------------------------------------------------------------
+    # Task operations
+    # ----------------------------------------------------------------------------------
+    def get_task(self, tc, task_id, requester=None):
+        """Return the task document, from the cache if the task is in a terminal state."""
+        entry = self._cached(task_id, requester)
+        if entry is not None and entry["task"] is not None:
+            self.hits += 1
+            return entry["task"]
+        self.misses += 1
+        if self.backend is None:
+            task = _response_data(tc.get_task(task_id))
+        else:
+            # Keyed by requester as well, so a task document is only shared with callers that could retrieve it
+            task = self.backend.single_flight(NS_TASK_STATUS, "{}:{}".format(task_id, _requester_hash(requester)),
+                                              lambda: _response_data(tc.get_task(task_id)), ttl=self.poll_ttl)
+        if task.get("status") in TERMINAL_TASK_STATUSES:
+            entry = self._lookup(task_id) or {"task": None, "cancel": None, "requesters": set()}
+            entry["task"] = task
+            entry["requesters"].add(_requester_hash(requester))
+            self._store(task_id, entry)
+        return task
+
+    def cancel_task(self, tc, task_id, requester=None):
+        """
+        Request that a task be cancelled. If the task is cached as terminal the request is answered locally,
+        with the stored cancel result or else the result Globus returns for a task that is already complete.
+        """
+        entry = self._cached(task_id, requester)
+        if entry is not None and entry["cancel"] is not None:
+            self.hits += 1
+            return entry["cancel"]
+        if entry is not None and entry["task"] is not None:
+            self.hits += 1
+            result = _task_complete_result(task_id)
+            entry["cancel"] = result
+            self._store(task_id, entry)
+            return result
+        self.misses += 1
+        result = _response_data(tc.cancel_task(task_id))
+        if result.get("code") in TERMINAL_CANCEL_CODES:
+            # A Canceled result does not mean the task document is final yet, so only the cancel result is kept.
+            # Later cancels are answered with TaskComplete, as Globus would, rather than repeating Canceled.
+            entry = self._lookup(task_id) or {"task": None, "cancel": None, "requesters": set()}
+            entry["cancel"] = result if result.get("code") == "TaskComplete" else _task_complete_result(task_id)
+            entry["requesters"].add(_requester_hash(requester))
+            self._store(task_id, entry)
+        return result
+
+    def stats(self):
+        """Return cache hit and miss counts."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+#
+# Cache of validated Globus tokens.
+#
+# Every proxy operation takes an access token and checkTokens takes an access/refresh token pair.
+# Validating or refreshing with Globus Auth on each request is the largest fixed cost of small requests.
+# Tokens that have been validated are kept in a bounded LRU along with their expiry, scopes and identity,
+# so Globus Auth is only called on a cache miss or when a token is close to expiring.
+# Tokens that Globus Auth reports as invalid are also cached, for a shorter time, so that repeated
+# requests with a bad token are rejected without calling Globus Auth.
+#
+# A shared state backend (see state_backend.py) may be given so that replicas of the proxy share validated tokens.
+# When a token is not cached, only one of the callers sharing the backend validates it with Globus Auth.
+#
+# The Globus identity of a set of tokens can also be looked up through the cache with identity(). The identity a
+# token was issued for never changes, so it is kept until the token expires and Globus Auth is asked only once.
+#
+# Tokens are never held in the cache. Entries are keyed by a SHA-256 hash of the token.
+#
+# Validation is done by a function taking a token and returning a dict in the form of a Globus Auth token
+# introspection response, i.e. with keys active, exp, scope, sub and username. Two are provided:
+#   introspect_validator() - Globus Auth token introspection. Needs a ConfidentialAppAuthClient.
+#   transfer_validator()   - a minimal Transfer API call made with the token. Works with tokens obtained using a
+#                            NativeAppAuthClient, as in these scripts, but gives no expiry or identity.
+#
+import collections
+import hashlib
+import threading
+import time
+from globus_sdk import AccessTokenAuthorizer, AuthClient, TransferClient
+from globus_sdk.exc import GlobusAPIError
+from state_backend import NS_IDENTITY, NS_TOKEN
+
+DEFAULT_MAX_ENTRIES = 10000
+# Treat tokens expiring within this many seconds as expired, so they are refreshed before use
+DEFAULT_EXPIRY_MARGIN = 60
+# Re-validate a token after this many seconds even if it has not expired, so revoked tokens are noticed
+DEFAULT_MAX_TTL = 300
+# How long to remember that a token is invalid
+DEFAULT_NEGATIVE_TTL = 60
+
+TRANSFER_RESOURCE_SERVER = "transfer.api.globus.org"
+AUTH_RESOURCE_SERVER = "auth.globus.org"
+TRANSFER_SCOPE = "urn:globus:auth:scope:transfer.api.globus.org:all"
+
+
+class InvalidTokenError(Exception):
+    """Raised when a token is not valid, either by Globus Auth or from the cache."""
+    pass
+
+
+def token_hash(token):
+    """Hash used as the cache key for a token."""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def introspect_validator(auth_client):
+    """
+    Return a validation function that uses Globus Auth token introspection.
+    auth_client must be a ConfidentialAppAuthClient.
+    """
+    def validate(token):
+        return dict(auth_client.oauth2_token_introspect(token).data)
+    return validate
+
+
+def transfer_validator():
+    """
+    Return a validation function that checks a transfer access token by listing at most one task with it.
+    Does not need a confidential client. Globus Transfer does not report the expiry or identity of the token,
+    so exp and sub are not returned and a valid token is re-checked after the cache max_ttl.
+    """
+    def validate(token):
+        tc = TransferClient(authorizer=AccessTokenAuthorizer(token))
+        try:
+            tc.task_list(limit=1)
+        except GlobusAPIError as ex:
+            if ex.http_status in (401, 403):
+                return {"active": False}
+            raise
+        return {"active": True, "scope": TRANSFER_SCOPE}
+    return validate
+
+
+def token_identity(tokens):
+    """
+    Return the Globus identity Id for a set of tokens keyed by resource server, as saved by get_tokens.py.
+    Uses the auth.globus.org access token if present. Return None if the identity cannot be determined.
+    """
+    auth_tokens = tokens.get(AUTH_RESOURCE_SERVER)
+    if not auth_tokens:
+        return None
+    try:
+        return AuthClient(authorizer=AccessTokenAuthorizer(auth_tokens["access_token"])).oauth2_userinfo()["sub"]
+    except GlobusAPIError:
+        return None
+
+
+def _entry_ttl(entry):
+    """Time in seconds for which a cache entry may be used."""
+    return max(0, entry["cache_until"] - time.time())
+
+
+class TokenCache:
+    """
+    Bounded LRU of validated tokens with negative caching of invalid tokens.
+    If backend is given, entries are also stored there and shared with other users of the backend.
+    """
+
+    def __init__(self, validate_fn, max_entries=DEFAULT_MAX_ENTRIES, expiry_margin=DEFAULT_EXPIRY_MARGIN,
+                 max_ttl=DEFAULT_MAX_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, backend=None):
+        self.validate_fn = validate_fn
+        self.backend = backend
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._identities = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        """Return the entry for a key if it is still usable, otherwise None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now < entry["cache_until"]:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+        if self.backend is None:
+            return None
+        entry = self.backend.get(NS_TOKEN, key)
+        if entry is None or now >= entry["cache_until"]:
+            return None
+        self._put(key, entry, share=False)
+        return entry
+
+    def _put(self, key, entry, share=True):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if share and self.backend is not None:
+            self.backend.set(NS_TOKEN, key, entry, ttl=_entry_ttl(entry))
+
+    def _valid_entry(self, expires_at, scopes, identity, username, now):
+        """Entry for a valid token. expires_at may be None if the validator does not know it."""
+        cache_until = now + self.max_ttl
+        if expires_at is not None:
+            cache_until = min(expires_at - self.expiry_margin, cache_until)
+        return {"active": True, "expires_at": expires_at, "scopes": scopes, "identity": identity,
+                "username": username, "cache_until": cache_until}
+
+    def _invalid_entry(self, now):
+        return {"active": False, "cache_until": now + self.negative_ttl}
+
+    def _put_valid(self, key, expires_at, scopes, identity, username, now):
+        """Cache a valid token."""
+        entry = self._valid_entry(expires_at, scopes, identity, username, now)
+        if entry["cache_until"] > now:
+            self._put(key, entry)
+        return entry
+
+    def _put_invalid(self, key, now):
+        entry = self._invalid_entry(now)
+        self._put(key, entry)
+        return entry
+
+    def _check(self, token):
+        """Call the validation function and return the cache entry for the token."""
+        now = time.time()
+        resp = self.validate_fn(token)
+        exp = resp.get("exp")
+        if resp.get("active") and (exp is None or exp - self.expiry_margin > now):
+            return self._valid_entry(exp, (resp.get("scope") or "").split(), resp.get("sub"), resp.get("username"),
+                                     now)
+        return self._invalid_entry(now)
+
+    def validate(self, token, required_scope=None):
+        """
+        Return the cache entry for a valid token: a dict with keys expires_at, scopes, identity and username.
+        Raise InvalidTokenError if the token is invalid, expires soon or lacks required_scope.
+        """
+        now = time.time()
+        key = token_hash(token)
+        entry = self._get(key, now)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if self.backend is None:
+                entry = self._check(token)
+                share = True
+            else:
+                # Only one of the callers sharing the backend validates the token. The others wait for its entry.
+                entry = self.backend.single_flight(NS_TOKEN, key, lambda: self._check(token), ttl=_entry_ttl)
+                share = False
+            if entry["cache_until"] > time.time():
+                self._put(key, entry, share=share)
+        if not entry["active"]:
+            raise InvalidTokenError("Access token invalid or expired.")
+        if required_scope is not None and required_scope not in entry["scopes"]:
+            raise InvalidTokenError("Access token does not have scope: {}".format(required_scope))
+        return entry
+
+    def add_token_response(self, token_data, identity=None, username=None):
+        """
+        Cache a token just issued by Globus Auth, e.g. from a code exchange or refresh, without validating it.
+        token_data is the data for one resource server, with keys access_token, expires_at_seconds and scope.
+        """
+        now = time.time()
+        return self._put_valid(token_hash(token_data["access_token"]), token_data["expires_at_seconds"],
+                               (token_data.get("scope") or "").split(), identity, username, now)
+
+    def identity(self, tokens):
+        """
+        Return the Globus identity Id for a set of tokens keyed by resource server, as saved by get_tokens.py.
+        Looked up with token_identity() the first time, then kept until the auth.globus.org access token expires.
+        Return None if the identity cannot be determined.
+        """
+        auth_tokens = tokens.get(AUTH_RESOURCE_SERVER)
+        if not auth_tokens:
+            return None
+        key = token_hash(auth_tokens["access_token"])
+        with self._lock:
+            identity = self._identities.get(key)
+            if identity is not None:
+                self._identities.move_to_end(key)
+        if identity is not None:
+            self.hits += 1
+            return identity
+        ttl = auth_tokens["expires_at_seconds"] - time.time()
+        if ttl <= 0:
+            return None
+        looked_up = []
+
+        def lookup():
+            looked_up.append(True)
+            return token_identity(tokens)
+        if self.backend is None:
+            identity = lookup()
+        else:
+            identity = self.backend.single_flight(NS_IDENTITY, key, lookup, ttl=ttl)
+        if looked_up:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if identity is not None:
+            with self._lock:
+                self._identities[key] = identity
+                while len(self._identities) > self.max_entries:
+                    self._identities.popitem(last=False)
+        return identity
+
+    def invalidate(self, token):
+        """Remove a token from the cache, e.g. after Globus rejects it."""
+        with self._lock:
+            self._entries.pop(token_hash(token), None)
+        if self.backend is not None:
+            self.backend.delete(NS_TOKEN, token_hash(token))
+
+    def check_tokens(self, auth_client, access_token, refresh_token):
+        """
+        Implementation of checkTokens. Return the pair (access_token, refresh_token), refreshed if needed.
+        If the access token is cached as valid and not close to expiring Globus Auth is not called.
+        Otherwise the tokens are refreshed using auth_client and the new access token is cached.
+        A refresh token that Globus Auth rejects is negatively cached and InvalidTokenError raised.
+        """
+        try:
+            self.validate(access_token)
+            return access_token, refresh_token
+        except InvalidTokenError:
+            pass
+        now = time.time()
+        refresh_key = token_hash(refresh_token)
+        entry = self._get(refresh_key, now)
+        if entry is not None and not entry["active"]:
+            self.hits += 1
+            raise InvalidTokenError("Refresh token invalid.")
+        try:
+            token_response = auth_client.oauth2_refresh_token(refresh_token)
+        except GlobusAPIError as ex:
+            if ex.http_status in (400, 401):
+                self._put_invalid(refresh_key, now)
+                raise InvalidTokenError("Refresh token invalid.")
+            raise
+        transfer_data = token_response.by_resource_server[TRANSFER_RESOURCE_SERVER]
+        self.add_token_response(transfer_data)
+        return transfer_data["access_token"], transfer_data.get("refresh_token") or refresh_token
+
+    def stats(self):
+        """Return cache hit and miss counts."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
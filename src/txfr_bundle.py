@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Small-file bundling for transfers sourced from a local directory, e.g. a Globus Connect Personal endpoint.
+#
+# Transfers of very many small files are dominated by per-file overhead. When the source directory is
+# reachable locally, small files can be packed into size-targeted tar archives in a staging directory
+# and the archives transferred instead. Files at or above the small file size are transferred directly.
+# A bundle manifest (JSON) listing the members of each archive is written to the staging directory and
+# transferred with the bundles. On the destination side the bundles are either unpacked with
+# unpack_bundles(), if the destination is also reachable locally, or left in place with the manifest.
+#
+# Typical use:
+#   plan = plan_bundles(local_src_dir)
+#   if plan["bundles"]:
+#       build_bundles(plan, local_src_dir, local_staging_dir)
+#   files_to_transfer = bundle_transfer_items(plan, ep_src_dir, ep_staging_dir, dst_dir)
+#   ... submit transfer of files_to_transfer and wait ...
+#   unpack_bundles(local_dst_dir)
+#
+import json
+import os
+import posixpath
+import tarfile
+
+# Bundling is only done if there are at least this many small files
+DEFAULT_MIN_FILE_COUNT = 1000
+# Files smaller than this are bundled
+DEFAULT_SMALL_FILE_SIZE = 1024 * 1024
+# Target size of each bundle, including tar headers and padding
+DEFAULT_BUNDLE_SIZE = 1024 * 1024 * 1024
+
+BUNDLE_MANIFEST_NAME = "bundle_manifest.json"
+BUNDLE_NAME_FORMAT = "bundle-{:06d}.tar"
+
+
+def _blocks(size):
+    """Number of tar blocks needed for size bytes."""
+    return -(-size // tarfile.BLOCKSIZE)
+
+
+def tar_member_size(rel_path, size):
+    """
+    Space taken by a file in a bundle: a header plus the data padded to whole blocks.
+    Names of 100 bytes or more also need an extended (pax) header holding the name.
+    """
+    blocks = 1 + _blocks(size)
+    name_len = len(rel_path.replace(os.sep, "/").encode("utf-8"))
+    if name_len >= tarfile.LENGTH_NAME:
+        # Header plus the "<length> path=<name>\n" record
+        blocks += 1 + _blocks(name_len + 16)
+    return blocks * tarfile.BLOCKSIZE
+
+
+def tar_archive_size(members_size):
+    """Size of a bundle whose members take members_size: two end blocks, padded to a whole record."""
+    return -(-(members_size + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def _whole_second_mtime(tarinfo):
+    """Store the modification time in whole seconds. A fractional time would need an extended header per file."""
+    tarinfo.mtime = int(tarinfo.mtime)
+    return tarinfo
+
+
+def plan_bundles(src_dir, min_file_count=DEFAULT_MIN_FILE_COUNT, small_file_size=DEFAULT_SMALL_FILE_SIZE,
+                 bundle_size=DEFAULT_BUNDLE_SIZE):
+    """
+    Walk a local source directory and decide which files to bundle.
+    Return a dict with keys 'bundles' (list of lists of relative paths) and 'direct' (relative paths
+    of files to transfer as is). If there are fewer than min_file_count small files nothing is bundled.
+    """
+    small = []
+    direct = []
+    for dir_path, dir_names, file_names in os.walk(src_dir):
+        dir_names.sort()
+        for name in sorted(file_names):
+            full_path = os.path.join(dir_path, name)
+            if os.path.islink(full_path) or not os.path.isfile(full_path):
+                continue
+            rel_path = os.path.relpath(full_path, src_dir)
+            size = os.path.getsize(full_path)
+            if size < small_file_size:
+                small.append((rel_path, size))
+            else:
+                direct.append(rel_path)
+    if len(small) < min_file_count:
+        return {"bundles": [], "direct": direct + [rel_path for rel_path, size in small]}
+
+    # Fill bundles in directory order so related files end up together
+    bundles = []
+    current = []
+    current_size = 0
+    for rel_path, size in small:
+        size = tar_member_size(rel_path, size)
+        if current and tar_archive_size(current_size + size) > bundle_size:
+            bundles.append(current)
+            current = []
+            current_size = 0
+        current.append(rel_path)
+        current_size += size
+    if current:
+        bundles.append(current)
+    return {"bundles": bundles, "direct": direct}
+
+
+def build_bundles(plan, src_dir, staging_dir):
+    """
+    Write the bundles from plan_bundles() as tar archives in the staging directory, along with the
+    bundle manifest. Return the list of bundle file names.
+    """
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    bundle_names = []
+    manifest = {"bundles": {}}
+    for idx, members in enumerate(plan["bundles"]):
+        bundle_name = BUNDLE_NAME_FORMAT.format(idx)
+        with tarfile.open(os.path.join(staging_dir, bundle_name), "w") as tar:
+            for rel_path in members:
+                tar.add(os.path.join(src_dir, rel_path), arcname=rel_path, recursive=False,
+                        filter=_whole_second_mtime)
+        manifest["bundles"][bundle_name] = members
+        bundle_names.append(bundle_name)
+    with open(os.path.join(staging_dir, BUNDLE_MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return bundle_names
+
+
+def bundle_transfer_items(plan, ep_src_dir, ep_staging_dir, dst_dir):
+    """
+    Build the list of transfer items for a bundled source directory.
+    ep_src_dir and ep_staging_dir are the source and staging directories as paths on the source endpoint.
+    Bundles and the bundle manifest are transferred to dst_dir, direct files to their relative path under dst_dir.
+    """
+    files_to_transfer = []
+    for rel_path in plan["direct"]:
+        rel_path = rel_path.replace(os.sep, "/")
+        files_to_transfer.append({'source': posixpath.join(ep_src_dir, rel_path),
+                                  'dest': posixpath.join(dst_dir, rel_path)})
+    if plan["bundles"]:
+        names = [BUNDLE_NAME_FORMAT.format(idx) for idx in range(len(plan["bundles"]))] + [BUNDLE_MANIFEST_NAME]
+        for name in names:
+            files_to_transfer.append({'source': posixpath.join(ep_staging_dir, name),
+                                      'dest': posixpath.join(dst_dir, name)})
+    return files_to_transfer
+
+
+def _safe_members(tar, dst_dir):
+    """Yield only regular file and directory members that extract inside dst_dir."""
+    dst_root = os.path.realpath(dst_dir)
+    for member in tar.getmembers():
+        if not (member.isfile() or member.isdir()):
+            continue
+        target = os.path.realpath(os.path.join(dst_root, member.name))
+        if target != dst_root and not target.startswith(dst_root + os.sep):
+            continue
+        yield member
+
+
+def unpack_bundles(dst_dir, remove_bundles=True):
+    """
+    Unpack bundles transferred to a locally reachable destination directory, using the bundle manifest.
+    If remove_bundles is True, each bundle is deleted once unpacked and the manifest is deleted at the end.
+    Return the number of files unpacked.
+    """
+    manifest_path = os.path.join(dst_dir, BUNDLE_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return 0
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    num_files = 0
+    for bundle_name, members in sorted(manifest["bundles"].items()):
+        bundle_path = os.path.join(dst_dir, bundle_name)
+        with tarfile.open(bundle_path, "r") as tar:
+            tar.extractall(dst_dir, members=_safe_members(tar, dst_dir))
+        num_files += len(members)
+        if remove_bundles:
+            os.remove(bundle_path)
+    if remove_bundles:
+        os.remove(manifest_path)
+    return num_files
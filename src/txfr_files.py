@@ -2,10 +2,19 @@
 #
 import json
 import datetime
+import sys
 import time
 from collections import deque
-from globus_sdk import NativeAppAuthClient, RefreshTokenAuthorizer, TransferClient, TransferData, DeleteData
+from endpoint_cache import EndpointStateCache
+from globus_sdk import NativeAppAuthClient, RefreshTokenAuthorizer, TransferClient, DeleteData
 from globus_sdk.exc import GlobusAPIError
+from proxy_trace import TraceRecorder, RecordingTransferClient
+from rate_limit import RateLimiter, RateLimitedTransferClient
+from state_backend import InProcessBackend, RedisBackend, SqliteBackend
+from task_cache import TerminalTaskCache
+from token_cache import TokenCache, transfer_validator, TRANSFER_RESOURCE_SERVER
+from txfr_verify import VERIFY_SAMPLED, add_source_sizes, submit_with_verification, submission_task_ids, \
+    verification_report
 
 # File containing access and refresh tokens
 TOKEN_FILE = "/home/scblack/.ssh/globus_tokens.json"
@@ -19,6 +28,44 @@ ENDPOINT_ID_DST = "4549fadc-7941-11ec-9f32-ed182a728dff"
 # Publicly available tutorial endpoint
 ENDPOINT_ID_SRC = "ddb59aef-6d04-11e5-ba46-22000b92c6ec"
 
+# Integrity verification for the transfer. See txfr_verify.py
+# Mode is one of: NONE, SIZE, SAMPLED, FULL
+# In SAMPLED mode a fraction of the files are checksummed, as is any file at or above the size threshold.
+VERIFY_MODE = VERIFY_SAMPLED
+VERIFY_SAMPLE_FRACTION = 0.1
+VERIFY_SIZE_THRESHOLD = 1024 * 1024 * 1024
+
+# State such as endpoints, activations, tokens and tasks is cached in a state backend. See state_backend.py
+# Set STATE_DB to a file path to keep it in a SQLite database shared by processes on this host,
+# or STATE_REDIS_HOST to a Redis host to share it between processes on several hosts.
+STATE_DB = None
+STATE_REDIS_HOST = None
+if STATE_REDIS_HOST is not None:
+    STATE_BACKEND = RedisBackend(STATE_REDIS_HOST)
+elif STATE_DB is not None:
+    STATE_BACKEND = SqliteBackend(STATE_DB)
+else:
+    STATE_BACKEND = InProcessBackend()
+
+# Cache for tasks in a terminal state. See task_cache.py
+# Set TASK_CACHE_DIR to a directory to keep cached tasks across runs.
+TASK_CACHE_DIR = None
+TASK_CACHE = TerminalTaskCache(max_entries=1000, cache_dir=TASK_CACHE_DIR, backend=STATE_BACKEND)
+
+# Cache of validated tokens. See token_cache.py
+# Tokens here come from a NativeAppAuthClient, so they are validated with a Transfer API call rather than
+# Globus Auth introspection, which needs a confidential client.
+TOKEN_CACHE = TokenCache(transfer_validator(), backend=STATE_BACKEND)
+
+# Set to a file path to record a sanitized trace of the calls made. See proxy_trace.py and proxy_replay.py
+TRACE_FILE = None
+# Secret salt for the hashed identifiers in the trace. If None a random salt is used, so runs appending to the same
+# trace file hash the same endpoints, tasks and users differently. Set it to keep them consistent across runs.
+TRACE_SALT = None
+
+# Client side rate limits for calls to Globus, e.g. {"endpoint": (10, 20)}. See rate_limit.py
+RATE_LIMITS = None
+
 # Code mostly taken from Globus python sdk examples and jpl-neid code
 # https://github.com/globus/native-app-examples
 # https://github.com/globus/globus-sdk-python
@@ -56,6 +103,7 @@ def update_tokens_file_on_refresh(token_response):
     Will be invoked any time a new access token is fetched.
     """
     save_tokens_to_file(TOKEN_FILE, token_response.by_resource_server)
+    TOKEN_CACHE.add_token_response(token_response.by_resource_server[TRANSFER_RESOURCE_SERVER])
     print("Saved tokens to file. Tokens:")
     print("============================================================================================")
     print(json.dumps(token_response.by_resource_server, indent=2, sort_keys=True))
@@ -88,9 +136,27 @@ def main():
     # get/refresh the tokens
     tokens = load_tokens_from_file(TOKEN_FILE)
     transfer_tokens = tokens["transfer.api.globus.org"]
+    # Globus Auth is only asked for the identity the first time these tokens are seen. With STATE_DB set the
+    # identity is also remembered across runs until the auth token expires.
+    identity = TOKEN_CACHE.identity(tokens)
+    print("Globus identity:", identity)
 
-    # Create the authorizer
+    # Check the tokens. Globus Auth is only called if the access token is not cached as valid or is close to expiring.
     auth_client = NativeAppAuthClient(client_id=CLIENT_ID)
+    access_token, refresh_token = TOKEN_CACHE.check_tokens(auth_client, transfer_tokens["access_token"],
+                                                           transfer_tokens["refresh_token"])
+    if access_token != transfer_tokens["access_token"]:
+        transfer_tokens["access_token"] = access_token
+        transfer_tokens["refresh_token"] = refresh_token
+        transfer_tokens["expires_at_seconds"] = TOKEN_CACHE.validate(access_token)["expires_at"]
+        save_tokens_to_file(TOKEN_FILE, tokens)
+        print("Refreshed tokens and saved to file.")
+
+    # Per user caches, the rate limiter and the trace identify the user by Globus identity, or by the refresh
+    # token if the identity is not known. Unlike the access token, neither changes when the authorizer refreshes.
+    requester = identity or transfer_tokens["refresh_token"]
+
+    # Create the authorizer
     authorizer = RefreshTokenAuthorizer(
         transfer_tokens["refresh_token"],
         auth_client,
@@ -106,11 +172,26 @@ def main():
 
     # Use the authorizer to create a client
     transfer_client = TransferClient(authorizer=authorizer)
+    # The trace is recorded inside the rate limiter, so recorded durations do not include admission delay
+    if TRACE_FILE is not None:
+        print("Recording trace to:", TRACE_FILE)
+        # The requester is only written hashed
+        transfer_client = RecordingTransferClient(transfer_client, TraceRecorder(TRACE_FILE, salt=TRACE_SALT),
+                                                  requester=requester)
+    rate_limiter = None
+    if RATE_LIMITS is not None:
+        print("Rate limiting calls to Globus. Limits:", RATE_LIMITS)
+        # Calls made by task_wait() to poll the task are also rate limited
+        rate_limiter = RateLimiter(RATE_LIMITS)
+        transfer_client = RateLimitedTransferClient(transfer_client, rate_limiter, identity=requester)
+
+    # Endpoints, activations and listings are cached for this user. See endpoint_cache.py
+    endpoint_cache = EndpointStateCache(STATE_BACKEND, requester=requester)
 
     # activate globus connect personal endpoint
     print("Activating connect personal endpoint:", ENDPOINT_ID_DST)
     try:
-        transfer_client.endpoint_autoactivate(ENDPOINT_ID_DST)
+        endpoint_cache.autoactivate(transfer_client, ENDPOINT_ID_DST)
     except GlobusAPIError as ex:
         print(ex)
         if ex.http_status == 401:
@@ -121,7 +202,7 @@ def main():
     # activate globus tutorial endpoint
     print("Activating tutorial endpoint:", ENDPOINT_ID_SRC)
     try:
-        transfer_client.endpoint_autoactivate(ENDPOINT_ID_SRC)
+        endpoint_cache.autoactivate(transfer_client, ENDPOINT_ID_SRC)
     except GlobusAPIError as ex:
         print(ex)
         if ex.http_status == 401:
@@ -136,14 +217,14 @@ def main():
                                                                         ep["default_directory"]))
 
     # Make call to get endpoint default dir
-    ep_personal = transfer_client.get_endpoint(ENDPOINT_ID_DST)
+    ep_personal = endpoint_cache.get_endpoint(transfer_client, ENDPOINT_ID_DST)
     # EP_DIR = "/~/data/globus"
     ep_personal_dir = ep_personal["default_directory"]
 
     # list files for connect personal endpoint
     print("============================================================================================")
     print("Listing files for personal endpoint:", ENDPOINT_ID_DST, " path: ", ep_personal_dir)
-    for fentry in transfer_client.operation_ls(ENDPOINT_ID_DST, path=ep_personal_dir):
+    for fentry in endpoint_cache.operation_ls(transfer_client, ENDPOINT_ID_DST, ep_personal_dir)["DATA"]:
         print("file:", json.dumps(fentry, indent=2, sort_keys=True))
     print("============================================================================================")
 
@@ -151,7 +232,7 @@ def main():
     ep_tut_dir = "/share/godata"
     print("============================================================================================")
     print("Listing files for tutorial endpoint:", ENDPOINT_ID_SRC, " path:", ep_tut_dir)
-    for fentry in transfer_client.operation_ls(ENDPOINT_ID_SRC, path=ep_tut_dir):
+    for fentry in endpoint_cache.operation_ls(transfer_client, ENDPOINT_ID_SRC, ep_tut_dir)["DATA"]:
         print("file:", json.dumps(fentry, indent=2, sort_keys=True))
     print("============================================================================================")
 
@@ -160,6 +241,7 @@ def main():
     print("============================================================================================")
     print("Creating new directory on personal endpoint. Dir:", dst_dir)
     transfer_client.operation_mkdir(ENDPOINT_ID_DST, path=dst_dir)
+    endpoint_cache.invalidate_listing(ENDPOINT_ID_DST, ep_personal_dir)
     print("============================================================================================")
 
     # Now transfer files from tutorial endpoint to new directory on personal endpoint
@@ -178,21 +260,23 @@ def main():
                          {'source': f2_src_path, 'dest': f2_dst_path},
                          {'source': f3_src_path, 'dest': f3_dst_path}]
 
-    txfr_data = TransferData(transfer_client, ENDPOINT_ID_SRC, ENDPOINT_ID_DST, label='', sync_level='size',
-                             verify_checksum=False)
-    for fentry in files_to_transfer:
-        txfr_data.add_item(fentry['source'], fentry['dest'])
+    # Get source file sizes. Used for the checksum size threshold and the post-transfer size check.
+    add_source_sizes(transfer_client, ENDPOINT_ID_SRC, files_to_transfer)
 
-    # Start the txfr
+    # Start the txfr. Depending on the verification mode there may be two tasks, one with checksums and one without.
     print("============================================================================================")
     print("Transferring files to connect personal dir:", dst_dir, " from tutorial ep dir:", src_dir)
-    txfr_response = transfer_client.submit_transfer(txfr_data)
-    print("Transfer submit response:")
+    print("Verification mode:", VERIFY_MODE)
+    submission = submit_with_verification(transfer_client, ENDPOINT_ID_SRC, ENDPOINT_ID_DST, files_to_transfer,
+                                          VERIFY_MODE, sample_fraction=VERIFY_SAMPLE_FRACTION,
+                                          size_threshold=VERIFY_SIZE_THRESHOLD, label='', sync_level='size')
+    print("Transfer submission:")
     print("============================================================================================")
-    print(txfr_response)
+    print(json.dumps(submission, indent=2, sort_keys=True))
     print("============================================================================================")
-    txfr_task_id = txfr_response["task_id"]
-    print("Transfer submit task_id:", txfr_task_id)
+    txfr_task_ids = submission_task_ids(submission)
+    txfr_task_id = txfr_task_ids[0]
+    print("Transfer submit task_ids:", txfr_task_ids)
     # TEST
     # TEST Immediately cancel
     # TEST Attempt cancel immediately, so we can see what response looks like
@@ -238,24 +322,39 @@ def main():
     print("Task status:", txfr_task_response["status"])
     print("============================================================================================")
 
-    # wait for txfr to finish
-    print("Waiting for transfer task to finish using timeout: 10 seconds, pollling_interval: 2")
-    txfr_done = transfer_client.task_wait(txfr_task_id, timeout=10, polling_interval=2)
-    if not txfr_done:
-        print("Transfer task did not complete.")
-        sys.exit(1)
-    else:
-        print("Transfer task completed.")
+    # wait for txfr tasks to finish
+    for task_id in txfr_task_ids:
+        print("Waiting for transfer task {} to finish using timeout: 10 seconds, pollling_interval: 2".format(task_id))
+        txfr_done = transfer_client.task_wait(task_id, timeout=10, polling_interval=2)
+        if not txfr_done:
+            print("Transfer task did not complete.")
+            sys.exit(1)
+        else:
+            print("Transfer task completed.")
     print("============================================================================================")
-    txfr_task_response = transfer_client.get_task(task_id=txfr_task_id)
+    txfr_task_response = TASK_CACHE.get_task(transfer_client, txfr_task_id, requester=requester)
     print("Transfer task status after transfer:", txfr_task_response["status"])
+    # Task is now complete so a second retrieval is answered from the cache
+    txfr_task_response = TASK_CACHE.get_task(transfer_client, txfr_task_id, requester=requester)
+    print("Transfer task status after transfer from cache:", txfr_task_response["status"])
+
+    # Post-transfer verification report
+    print("Verification report:")
+    print("============================================================================================")
+    print(json.dumps(verification_report(transfer_client, submission), indent=2, sort_keys=True))
+    print("============================================================================================")
 
     # Attempt cancel even though task is done, so we can see what response looks like
-    task_cancel_resp = transfer_client.cancel_task(txfr_task_id)
+    # Since the task is cached as complete the response is produced locally without calling Globus.
+    task_cancel_resp = TASK_CACHE.cancel_task(transfer_client, txfr_task_id, requester=requester)
     print("Made cancel request. Cancel response:")
     print("============================================================================================")
     print(task_cancel_resp)
     print("============================================================================================")
+    print("Task cache stats:", TASK_CACHE.stats())
+    print("Endpoint cache stats:", endpoint_cache.stats())
+    if rate_limiter is not None:
+        print("Rate limiter admission delays:", json.dumps(rate_limiter.metrics(), sort_keys=True))
 
     # rename a file on personal endpoint
     f1a = "file1a.txt"
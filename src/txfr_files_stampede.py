@@ -5,8 +5,9 @@ import datetime
 import sys
 import time
 from collections import deque
-from globus_sdk import NativeAppAuthClient, RefreshTokenAuthorizer, TransferClient, TransferData, DeleteData
+from globus_sdk import NativeAppAuthClient, RefreshTokenAuthorizer, TransferClient, DeleteData
 from globus_sdk.exc import GlobusAPIError
+from txfr_manifest import open_manifest, submit_pending_chunks, wait_for_chunks, manifest_summary
 
 # Test transfer of files from SRC: TACC Stampede2 endpoint to DST Connect personal endpoint on laptop
 
@@ -24,6 +25,13 @@ ENDPOINT_ID_DST = "4549fadc-7941-11ec-9f32-ed182a728dff"
 ENDPOINT_ID_SRC = "7961b534-3f0e-11e7-bd15-22000b9a448b"
 
 
+# Manifest recording which chunks of the transfer have been submitted and completed. See txfr_manifest.py
+# If the script exits before the transfer finishes, re-running it resumes the transfer using this file.
+# Remove the file to start a new transfer job.
+MANIFEST_FILE = "/home/scblack/.ssh/globus_txfr_manifest.jsonl"
+# Maximum number of items in each transfer task
+MANIFEST_CHUNK_SIZE = 1000
+
 # Publicly available tutorial endpoint
 # ENDPOINT_ID_SRC = "ddb59aef-6d04-11e5-ba46-22000b92c6ec"
 
@@ -185,7 +193,14 @@ def main():
     dst_dir = "{}/new_dir".format(ep_dst_dir)
     print("============================================================================================")
     print("Creating new directory on destination endpoint. Dir:", dst_dir)
-    transfer_client.operation_mkdir(ENDPOINT_ID_DST, path=dst_dir)
+    # Directory will already exist when re-running to resume a transfer using the manifest
+    try:
+        transfer_client.operation_mkdir(ENDPOINT_ID_DST, path=dst_dir)
+    except GlobusAPIError as ex:
+        if ex.code == "ExternalError.MkdirFailed.Exists":
+            print("Directory already exists. Dir:", dst_dir)
+        else:
+            raise ex
     print("============================================================================================")
 
     # Now transfer files from source to destination
@@ -204,21 +219,20 @@ def main():
                          {'source': f2_src_path, 'dest': f2_dst_path},
                          {'source': f3_src_path, 'dest': f3_dst_path}]
 
-    txfr_data = TransferData(transfer_client, ENDPOINT_ID_SRC, ENDPOINT_ID_DST, label='', sync_level='size',
-                             verify_checksum=False)
-    for fentry in files_to_transfer:
-        txfr_data.add_item(fentry['source'], fentry['dest'])
+    # Load or create the manifest for the transfer job
+    manifest = open_manifest(MANIFEST_FILE, ENDPOINT_ID_SRC, ENDPOINT_ID_DST, files_to_transfer,
+                             chunk_size=MANIFEST_CHUNK_SIZE)
+    print("Transfer manifest:", MANIFEST_FILE, " chunk states:", manifest_summary(manifest))
 
-    # Start the txfr
+    # Start the txfr. Only chunks not already submitted, or whose task failed, are submitted.
     print("============================================================================================")
     print("Transferring files to destination dir:", dst_dir, " from source dir:", src_dir)
-    txfr_response = transfer_client.submit_transfer(txfr_data)
-    print("Transfer submit response:")
-    print("============================================================================================")
-    print(txfr_response)
+    submitted_task_ids = submit_pending_chunks(transfer_client, MANIFEST_FILE, manifest, label='',
+                                               sync_level='size', verify_checksum=False)
+    print("Transfer submitted task_ids:", submitted_task_ids)
     print("============================================================================================")
-    txfr_task_id = txfr_response["task_id"]
-    print("Transfer submit task_id:", txfr_task_id)
+    txfr_task_id = manifest["chunks"][0]["task_id"]
+    print("Transfer task_id for first chunk:", txfr_task_id)
     # TEST
     # TEST Immediately cancel
     # TEST Attempt cancel immediately, so we can see what response looks like
@@ -264,11 +278,12 @@ def main():
     print("Task status:", txfr_task_response["status"])
     print("============================================================================================")
 
-    # wait for txfr to finish
-    print("Waiting for transfer task to finish using timeout: 10 seconds, pollling_interval: 2")
-    txfr_done = transfer_client.task_wait(txfr_task_id, timeout=10, polling_interval=2)
+    # wait for txfr to finish. Progress is recorded in the manifest so the transfer can be resumed.
+    print("Waiting for transfer tasks to finish using timeout: 10 seconds, pollling_interval: 2")
+    txfr_done = wait_for_chunks(transfer_client, MANIFEST_FILE, manifest, timeout=10, polling_interval=2)
+    print("Transfer manifest chunk states:", manifest_summary(manifest))
     if not txfr_done:
-        print("Transfer task did not complete.")
+        print("Transfer tasks did not complete. Run again to resume using manifest:", MANIFEST_FILE)
         sys.exit(1)
     else:
         print("Transfer task completed.")
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+#
+# Checkpointed transfer manifests with crash-safe resume.
+#
+# A logical transfer job is split into chunks, each submitted as a separate Globus transfer task.
+# Progress is recorded in a manifest file, one JSON record per line. Records are only ever appended
+# and each one is flushed and fsync'd before the operation it describes is relied on.
+# If the script dies partway, for example at a task_wait timeout, running it again with the same
+# manifest file reattaches to tasks already submitted and only submits chunks that are missing or failed.
+#
+# Record types:
+#   job       - source and destination endpoints, chunk size and a fingerprint of the items.
+#   chunk     - chunk index and the items in the chunk.
+#   submit    - chunk index and the Globus submission_id, written BEFORE submitting.
+#   task      - chunk index and the task_id returned by Globus.
+#   status    - chunk index, task_id and a terminal task status (SUCCEEDED or FAILED).
+#
+# The submission_id is obtained from Globus and journaled before the submit. If we crash after submitting
+# but before recording the task_id, the resubmit reuses the same submission_id and Globus returns the
+# original task rather than starting a second copy of the transfer.
+#
+import hashlib
+import json
+import os
+import time
+from globus_sdk import TransferData
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Chunk states derived from the manifest
+CHUNK_PENDING = "PENDING"
+CHUNK_SUBMITTED = "SUBMITTED"
+CHUNK_SUCCEEDED = "SUCCEEDED"
+CHUNK_FAILED = "FAILED"
+
+
+def _items_fingerprint(files_to_transfer):
+    """Hash of the transfer items. Used to detect a manifest being reused for a different job."""
+    h = hashlib.sha256()
+    for fentry in files_to_transfer:
+        h.update(fentry['source'].encode("utf-8"))
+        h.update(b"\0")
+        h.update(fentry['dest'].encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def _append_records(manifest_path, records):
+    """Append records to the manifest and fsync before returning."""
+    new_file = not os.path.exists(manifest_path)
+    with open(manifest_path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    if new_file:
+        # Make sure the directory entry for a newly created manifest is also durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(manifest_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def _repair_torn_tail(manifest_path):
+    """
+    Truncate a partially written last record, as left by a crash during a write.
+    Must be done before appending, otherwise the next record would be joined to the partial one.
+    """
+    with open(manifest_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def load_manifest(manifest_path):
+    """
+    Replay a manifest file and return the job state, or None if the manifest does not exist.
+    A partially written last line, as left by a crash during a write, is ignored.
+    State is a dict with keys 'job' and 'chunks'. Chunks is a list of dicts with keys
+    'items', 'state', 'submission_id' and 'task_id'.
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        lines = f.read().split("\n")
+    job = None
+    chunks = []
+    for line_num, line in enumerate(lines):
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if line_num == len(lines) - 1:
+                break
+            raise ValueError("Corrupt record at line {} of manifest: {}".format(line_num + 1, manifest_path))
+        rec_type = record["type"]
+        if rec_type == "job":
+            job = record
+        elif rec_type == "chunk":
+            chunks.append({"items": record["items"], "state": CHUNK_PENDING, "submission_id": None,
+                           "task_id": None})
+        elif rec_type == "submit":
+            chunk = chunks[record["chunk"]]
+            chunk["submission_id"] = record["submission_id"]
+            chunk["task_id"] = None
+            chunk["state"] = CHUNK_PENDING
+        elif rec_type == "task":
+            chunk = chunks[record["chunk"]]
+            chunk["task_id"] = record["task_id"]
+            chunk["state"] = CHUNK_SUBMITTED
+        elif rec_type == "status":
+            chunk = chunks[record["chunk"]]
+            if chunk["task_id"] == record["task_id"]:
+                chunk["state"] = record["status"]
+    if job is None:
+        raise ValueError("Manifest has no job record: {}".format(manifest_path))
+    return {"job": job, "chunks": chunks}
+
+
+def create_manifest(manifest_path, src_ep, dst_ep, files_to_transfer, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write a new manifest describing the job and its chunks. Return the job state."""
+    records = [{"type": "job", "source_endpoint_id": src_ep, "destination_endpoint_id": dst_ep,
+                "chunk_size": chunk_size, "num_items": len(files_to_transfer),
+                "fingerprint": _items_fingerprint(files_to_transfer)}]
+    for i in range(0, len(files_to_transfer), chunk_size):
+        records.append({"type": "chunk", "chunk": len(records) - 1, "items": files_to_transfer[i:i + chunk_size]})
+    _append_records(manifest_path, records)
+    return load_manifest(manifest_path)
+
+
+def open_manifest(manifest_path, src_ep, dst_ep, files_to_transfer, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Load the manifest for a job, creating it if it does not exist.
+    Raise ValueError if an existing manifest was written for a different job.
+    """
+    if os.path.exists(manifest_path):
+        _repair_torn_tail(manifest_path)
+    state = load_manifest(manifest_path)
+    if state is None:
+        return create_manifest(manifest_path, src_ep, dst_ep, files_to_transfer, chunk_size)
+    job = state["job"]
+    if (job["source_endpoint_id"] != src_ep or job["destination_endpoint_id"] != dst_ep or
+            job["fingerprint"] != _items_fingerprint(files_to_transfer)):
+        raise ValueError("Manifest {} was created for a different transfer job.".format(manifest_path))
+    return state
+
+
+def submit_pending_chunks(tc, manifest_path, state, label='', sync_level='size', verify_checksum=False):
+    """
+    Submit each chunk that has no task or whose task failed. Chunks already submitted are left alone.
+    Return the list of task_ids submitted by this call.
+    """
+    job = state["job"]
+    submitted = []
+    for idx, chunk in enumerate(state["chunks"]):
+        if chunk["state"] in (CHUNK_SUBMITTED, CHUNK_SUCCEEDED):
+            continue
+        if chunk["state"] == CHUNK_FAILED or chunk["submission_id"] is None:
+            # New submission. Record the id first so a crash after submit does not create a duplicate task.
+            chunk["submission_id"] = tc.get_submission_id()["value"]
+            _append_records(manifest_path, [{"type": "submit", "chunk": idx,
+                                             "submission_id": chunk["submission_id"]}])
+        txfr_data = TransferData(tc, job["source_endpoint_id"], job["destination_endpoint_id"], label=label,
+                                 sync_level=sync_level, verify_checksum=verify_checksum,
+                                 submission_id=chunk["submission_id"])
+        for fentry in chunk["items"]:
+            txfr_data.add_item(fentry['source'], fentry['dest'])
+        txfr_response = tc.submit_transfer(txfr_data)
+        chunk["task_id"] = txfr_response["task_id"]
+        chunk["state"] = CHUNK_SUBMITTED
+        _append_records(manifest_path, [{"type": "task", "chunk": idx, "task_id": chunk["task_id"]}])
+        submitted.append(chunk["task_id"])
+    return submitted
+
+
+def refresh_chunk_status(tc, manifest_path, state):
+    """
+    Check the status of every submitted chunk and journal any that have reached a terminal state.
+    Return True if all chunks have succeeded.
+    """
+    for idx, chunk in enumerate(state["chunks"]):
+        if chunk["state"] != CHUNK_SUBMITTED:
+            continue
+        status = tc.get_task(chunk["task_id"])["status"]
+        if status in (CHUNK_SUCCEEDED, CHUNK_FAILED):
+            chunk["state"] = status
+            _append_records(manifest_path, [{"type": "status", "chunk": idx, "task_id": chunk["task_id"],
+                                             "status": status}])
+    return all(chunk["state"] == CHUNK_SUCCEEDED for chunk in state["chunks"])
+
+
+def wait_for_chunks(tc, manifest_path, state, timeout=10, polling_interval=2):
+    """
+    Poll submitted chunks until all succeed, one fails or timeout seconds pass.
+    Return True if all chunks succeeded.
+    """
+    deadline = time.time() + timeout
+    while True:
+        if refresh_chunk_status(tc, manifest_path, state):
+            return True
+        if any(chunk["state"] == CHUNK_FAILED for chunk in state["chunks"]) or time.time() >= deadline:
+            return False
+        time.sleep(polling_interval)
+
+
+def manifest_summary(state):
+    """Return a count of chunks in each state."""
+    summary = {CHUNK_PENDING: 0, CHUNK_SUBMITTED: 0, CHUNK_SUCCEEDED: 0, CHUNK_FAILED: 0}
+    for chunk in state["chunks"]:
+        summary[chunk["state"]] += 1
+    return summary
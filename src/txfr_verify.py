@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Tiered integrity verification for Globus transfers.
+#
+# Checksumming every file (verify_checksum=True) roughly doubles transfer time for large datasets, while
+# turning it off entirely leaves no integrity check at all. These methods split a set of transfer items
+# into a checksum verified task and an unverified task according to a verification mode, and build a
+# report once the tasks have finished.
+#
+# Verification modes, as in VerificationModeEnum of GlobusProxyAPI.yaml:
+#   NONE    - no checksums, no post-transfer checks.
+#   SIZE    - no checksums. After transfer destination file sizes are compared to source sizes.
+#   SAMPLED - checksum a fraction of the files and/or every file at or above a size threshold.
+#             Remaining files get the post-transfer size check.
+#   FULL    - checksum every file.
+#
+import hashlib
+import posixpath
+from globus_sdk import TransferData
+
+VERIFY_NONE = "NONE"
+VERIFY_SIZE = "SIZE"
+VERIFY_SAMPLED = "SAMPLED"
+VERIFY_FULL = "FULL"
+VERIFY_MODES = (VERIFY_NONE, VERIFY_SIZE, VERIFY_SAMPLED, VERIFY_FULL)
+
+# Defaults for SAMPLED mode
+DEFAULT_SAMPLE_FRACTION = 0.1
+DEFAULT_SIZE_THRESHOLD = None
+
+
+def add_source_sizes(tc, src_ep, files_to_transfer):
+    """
+    Fill in the size of each transfer item from a listing of the source endpoint.
+    One operation_ls is made per source directory rather than one per file.
+    Items are dicts with keys 'source' and 'dest'. Key 'size' is set if the file is found.
+    """
+    by_dir = {}
+    for fentry in files_to_transfer:
+        by_dir.setdefault(posixpath.dirname(fentry['source']), []).append(fentry)
+    for src_dir, entries in by_dir.items():
+        sizes = {item["name"]: item["size"] for item in tc.operation_ls(src_ep, path=src_dir)
+                 if item["type"] == "file"}
+        for fentry in entries:
+            name = posixpath.basename(fentry['source'])
+            if name in sizes:
+                fentry['size'] = sizes[name]
+    return files_to_transfer
+
+
+def _in_sample(path, sample_fraction):
+    """
+    Deterministically decide if a path is part of the checksum sample.
+    Based on a hash of the path so that a re-run selects the same files.
+    """
+    if sample_fraction <= 0:
+        return False
+    if sample_fraction >= 1:
+        return True
+    digest = hashlib.sha1(path.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / float(1 << 64) < sample_fraction
+
+
+def split_transfer_items(files_to_transfer, mode, sample_fraction=DEFAULT_SAMPLE_FRACTION,
+                         size_threshold=DEFAULT_SIZE_THRESHOLD):
+    """
+    Split transfer items into a tuple of lists (verified, unverified).
+    Verified items are transferred with verify_checksum=True.
+    """
+    if mode not in VERIFY_MODES:
+        raise ValueError("Invalid verification mode: {}. Must be one of: {}".format(mode, ", ".join(VERIFY_MODES)))
+    if mode == VERIFY_FULL:
+        return list(files_to_transfer), []
+    if mode in (VERIFY_NONE, VERIFY_SIZE):
+        return [], list(files_to_transfer)
+    verified = []
+    unverified = []
+    for fentry in files_to_transfer:
+        size = fentry.get('size')
+        big_file = size_threshold is not None and size is not None and size >= size_threshold
+        if big_file or _in_sample(fentry['source'], sample_fraction):
+            verified.append(fentry)
+        else:
+            unverified.append(fentry)
+    return verified, unverified
+
+
+def submit_with_verification(tc, src_ep, dst_ep, files_to_transfer, mode,
+                             sample_fraction=DEFAULT_SAMPLE_FRACTION, size_threshold=DEFAULT_SIZE_THRESHOLD,
+                             label='', sync_level='size'):
+    """
+    Submit the transfer items as up to two tasks, one with checksum verification and one without.
+    Return a dict describing the submission which can later be passed to verification_report().
+    """
+    verified, unverified = split_transfer_items(files_to_transfer, mode, sample_fraction, size_threshold)
+    submission = {
+        "mode": mode,
+        "source_endpoint_id": src_ep,
+        "destination_endpoint_id": dst_ep,
+        "verified_task_id": None,
+        "unverified_task_id": None,
+        "verified_items": verified,
+        "unverified_items": unverified,
+    }
+    for items, verify_checksum, key in ((verified, True, "verified_task_id"),
+                                        (unverified, False, "unverified_task_id")):
+        if not items:
+            continue
+        txfr_data = TransferData(tc, src_ep, dst_ep, label=label, sync_level=sync_level,
+                                 verify_checksum=verify_checksum)
+        for fentry in items:
+            txfr_data.add_item(fentry['source'], fentry['dest'])
+        txfr_response = tc.submit_transfer(txfr_data)
+        submission[key] = txfr_response["task_id"]
+    return submission
+
+
+def submission_task_ids(submission):
+    """Return the list of task ids created by submit_with_verification()."""
+    return [tid for tid in (submission["verified_task_id"], submission["unverified_task_id"]) if tid]
+
+
+def verification_report(tc, submission):
+    """
+    Build a post-transfer verification report for a submission made by submit_with_verification().
+    Should be called after the tasks have finished.
+    For SIZE, SAMPLED and FULL modes the destination size of each unverified file is compared to the source size.
+    Sizes are only compared when the source size is known, see add_source_sizes().
+    """
+    mode = submission["mode"]
+    report = {
+        "mode": mode,
+        "tasks": [],
+        "files_checksummed": 0,
+        "files_size_checked": 0,
+        "size_mismatches": [],
+        "missing_files": [],
+    }
+    for task_id, verify_checksum in ((submission["verified_task_id"], True),
+                                     (submission["unverified_task_id"], False)):
+        if not task_id:
+            continue
+        task = tc.get_task(task_id)
+        report["tasks"].append({
+            "task_id": task_id,
+            "verify_checksum": verify_checksum,
+            "status": task["status"],
+            "files": task["files"],
+            "files_transferred": task["files_transferred"],
+            "files_skipped": task["files_skipped"],
+            "faults": task["faults"],
+        })
+        if verify_checksum and task["status"] == "SUCCEEDED":
+            # Files skipped by sync_level were not transferred, so were not checksummed
+            report["files_checksummed"] = task["files_transferred"]
+
+    if mode == VERIFY_NONE:
+        report["ok"] = all(t["status"] == "SUCCEEDED" for t in report["tasks"])
+        return report
+
+    # Size check the unverified files. One listing per destination directory.
+    dst_ep = submission["destination_endpoint_id"]
+    by_dir = {}
+    for fentry in submission["unverified_items"]:
+        if fentry.get('size') is not None:
+            by_dir.setdefault(posixpath.dirname(fentry['dest']), []).append(fentry)
+    for dst_dir, entries in by_dir.items():
+        sizes = {item["name"]: item["size"] for item in tc.operation_ls(dst_ep, path=dst_dir)
+                 if item["type"] == "file"}
+        for fentry in entries:
+            name = posixpath.basename(fentry['dest'])
+            report["files_size_checked"] += 1
+            if name not in sizes:
+                report["missing_files"].append(fentry['dest'])
+            elif sizes[name] != fentry['size']:
+                report["size_mismatches"].append({"path": fentry['dest'], "expected": fentry['size'],
+                                                  "actual": sizes[name]})
+    report["ok"] = (all(t["status"] == "SUCCEEDED" for t in report["tasks"]) and
+                    not report["size_mismatches"] and not report["missing_files"])
+    return report